@@ -0,0 +1 @@
+c:\Python27\python.exe run-benchmark.py
\ No newline at end of file
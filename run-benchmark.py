@@ -0,0 +1,189 @@
+"""
+LICENSE
+
+    pysrd - Python scripts for working with the DND35 OGL SRD.
+    Copyright (C) 2012, 2013 Richard Tew
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+OVERVIEW
+
+    Benchmarks the html extraction done by run-parse-html.py, without needing
+    the OpenSRD html files or the DND35 SQLite database.
+
+    The extractors are run against the fixture html files in BENCHMARK_DIR_NAME,
+    and against copies scaled up by repeating the regions marked in them with
+    "<!-- repeat -->" and "<!-- /repeat -->" comments.  Each extractor is run
+    in a fresh process for each scale, so that its peak memory use can be
+    measured.  Throughput is reported in rows per second and MB of html per
+    second, with the parse and extraction times being the best of several
+    repetitions.
+
+    Command line options:
+        --scales N,N..:     Scales to run the fixtures at (default: 1,10,100).
+        --repeat N:         Times to repeat each measurement (default: 3).
+        --parser NAME:      The html parser bs4 uses, as for run-parse-html.py.
+        --report FILE:      Also write the results to FILE as JSON.
+"""
+
+import argparse
+import imp
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    # Peak memory use is only measured where the resource module exists.
+    resource = None
+
+
+BENCHMARK_DIR_NAME = "benchmark"
+
+repeat_region_re = re.compile("<!-- repeat -->(.*?)<!-- /repeat -->", re.DOTALL)
+
+# The extractors benchmarked.
+extractor_names = [ "conditions", "special_abilities", "abilities", "abilities_table" ]
+
+
+def load_parse_html():
+    # The script name is not a valid module name, so it is loaded by path.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run-parse-html.py")
+    return imp.load_source("parse_html", path)
+
+
+def write_scaled_fixtures(fixture_path, scale, output_path):
+    """Write copies of the fixture html files with each marked region repeated."""
+    for file_name in sorted(os.listdir(fixture_path)):
+        if not file_name.endswith(".html"):
+            continue
+        with open(os.path.join(fixture_path, file_name), "r") as f:
+            html = f.read()
+        html = repeat_region_re.sub(lambda m: m.group(1) * scale, html)
+        with open(os.path.join(output_path, file_name), "w") as f:
+            f.write(html)
+
+
+def peak_memory():
+    """The peak resident memory of this process in MB, where known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, but OS X reports bytes.
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def benchmark_extractor(args):
+    """
+        Measure one extractor on one set of fixture files.  This runs in a
+        fresh process, so the peak memory is that of this extractor alone.
+    """
+    html_path, parser, name, repeat = args
+    parse_html = load_parse_html()
+    for (extractor_name, file_name, func, version) in parse_html.extractors:
+        if extractor_name == name:
+            break
+    else:
+        raise Exception, "unknown extractor %s" % name
+
+    timer = parse_html.timer
+    base_memory = peak_memory()
+    parse_times = []
+    extract_times = []
+    for i in range(repeat):
+        profile = parse_html.BuildProfile()
+        documents = parse_html.DocumentCache(html_path, parser, profile)
+        soup = documents.get(file_name)
+        start_time = timer()
+        cb = parse_html.RowCollector(name)
+        func(soup, cb)
+        extract_times.append(timer() - start_time)
+        parse_times.append(profile.files[file_name]["parse"])
+        rows = sum(len(table_rows) for (table_name, table_rows) in cb.tables)
+        del documents, soup, cb
+
+    return {
+        "extractor": name,
+        "file": file_name,
+        "bytes": os.path.getsize(os.path.join(html_path, file_name)),
+        "rows": rows,
+        "parse": min(parse_times),
+        "extract": min(extract_times),
+        "base_memory_mb": base_memory,
+        "peak_memory_mb": peak_memory(),
+    }
+
+
+def run(scales, repeat, parser, report_path=None):
+    fixture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), BENCHMARK_DIR_NAME)
+    results = []
+
+    sys.stdout.write("%-6s %-18s %8s %10s %8s %8s %10s %8s %9s%s" % ("scale", "extractor", "rows", "bytes",
+        "parse", "extract", "rows/s", "MB/s", "peak MB", os.linesep))
+    for scale in scales:
+        html_path = tempfile.mkdtemp(prefix="pysrd-benchmark-")
+        try:
+            write_scaled_fixtures(fixture_path, scale, html_path)
+            for name in extractor_names:
+                # A new process for every measurement keeps the peak memory of each separate.
+                pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                try:
+                    result = pool.apply(benchmark_extractor, ((html_path, parser, name, repeat),))
+                finally:
+                    pool.close()
+                    pool.join()
+
+                result["scale"] = scale
+                elapsed_time = result["parse"] + result["extract"]
+                result["rows_per_second"] = result["rows"] / elapsed_time
+                result["mb_per_second"] = result["bytes"] / (1024.0 * 1024.0) / elapsed_time
+                results.append(result)
+
+                sys.stdout.write("%-6s %-18s %8d %10d %7.3fs %7.3fs %10.0f %8.2f %9s%s" % ("%dx" % scale, name,
+                    result["rows"], result["bytes"], result["parse"], result["extract"],
+                    result["rows_per_second"], result["mb_per_second"],
+                    "%.1f" % result["peak_memory_mb"] if result["peak_memory_mb"] is not None else "?",
+                    os.linesep))
+        finally:
+            shutil.rmtree(html_path)
+
+    if report_path is not None:
+        report = { "parser": parser, "repeat": repeat, "results": results }
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parse_html = load_parse_html()
+
+    parser = argparse.ArgumentParser(description="Benchmark the html extraction of run-parse-html.py.")
+    parser.add_argument("--scales", default="1,10,100",
+        help="comma separated scales to run the fixtures at (default: 1,10,100)")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+        help="times to repeat each measurement, keeping the best (default: 3)")
+    parser.add_argument("-p", "--parser", choices=parse_html.HTML_PARSERS, default=parse_html.DEFAULT_HTML_PARSER,
+        help="html parser used by bs4 (default: %s)" % parse_html.DEFAULT_HTML_PARSER)
+    parser.add_argument("-r", "--report", metavar="FILE",
+        help="also write the results to FILE as JSON")
+    options = parser.parse_args()
+
+    scales = [ int(scale) for scale in options.scales.split(",") ]
+    run(scales, max(1, options.repeat), options.parser, options.report)
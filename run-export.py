@@ -0,0 +1,309 @@
+"""
+LICENSE
+
+    pysrd - Python scripts for working with the DND35 OGL SRD.
+    Copyright (C) 2012, 2013 Richard Tew
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+OVERVIEW
+
+    Exports tables from the DND35 SQLite database to files, for use where
+    SQLite is not.  Rows are streamed from the database to the files, so the
+    memory used does not grow with the size of a table.
+
+    Each table is written to a file named after it, in one of these formats:
+        ndjson:     "<table>.ndjson", a JSON object per line for each row.
+        csv:        "<table>.csv", with a header line of column names.
+        columnar:   "<table>.columns.json", a JSON object with the table name,
+                    row count, the name and type of each column, and the
+                    values of each column as an array in "data".  The type is
+                    one of "integer", "real", "text" or "blob", after the
+                    affinity SQLite gives the declared column type.
+
+    Html text stored compressed by run-parse-html.py is exported as text, and
+    any other BLOB value as base64 encoded text.
+
+    Command line options:
+        TABLE ..:           The tables to export (default: all those with data,
+                            excluding the search index and build manifest).
+        --format FORMAT:    One of "ndjson" (the default), "csv" or "columnar".
+        --output DIR:       The directory the files are written to (default:
+                            "export").
+        --gzip:             Compress each file with gzip, adding ".gz" to its
+                            name.
+        --jobs N:           Export tables in N worker processes.
+        --index:            Also write "index.json", mapping the name of every
+                            row to its id for each table with both columns.
+                            A name shared by several rows maps to a list of
+                            their ids.
+"""
+
+import argparse
+import base64
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from srd_tables import data_table_names, decode_fulltext
+
+
+DATABASE_FILENAME = "dnd35.sqlite"
+EXPORT_DIR_NAME = "export"
+EXPORT_FORMATS = [ "ndjson", "csv", "columnar" ]
+DEFAULT_EXPORT_FORMAT = "ndjson"
+INDEX_FILENAME = "index.json"
+
+# Per-column typing follows the SQLite rules for column affinity.
+column_affinities = [
+    ("INT",     "integer"),
+    ("CHAR",    "text"),
+    ("CLOB",    "text"),
+    ("TEXT",    "text"),
+    ("BLOB",    "blob"),
+    ("REAL",    "real"),
+    ("FLOA",    "real"),
+    ("DOUB",    "real"),
+]
+
+json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def export_tables(c):
+    """The names of the tables with data to export."""
+    c.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+    return data_table_names(c.fetchall())
+
+
+def column_affinity(declared_type):
+    declared_type = (declared_type or "").upper()
+    for (fragment, affinity) in column_affinities:
+        if fragment in declared_type:
+            return affinity
+    if not declared_type:
+        return "blob"
+    return "real"
+
+
+def table_columns(c, table_name):
+    """A list of (column name, type) for the table."""
+    c.execute("PRAGMA table_info(\"%s\")" % table_name)
+    return [ (row[1], column_affinity(row[2])) for row in c.fetchall() ]
+
+
+def decode_value(value):
+    value = decode_fulltext(value)
+    if isinstance(value, buffer):
+        return base64.b64encode(value)
+    return value
+
+
+def open_output(file_path, compress):
+    if compress:
+        return gzip.open(file_path +".gz", "wb")
+    return open(file_path, "wb")
+
+
+def encode_json(value):
+    return json_encoder.encode(decode_value(value)).encode("utf-8")
+
+
+def write_ndjson(c, table_name, columns, f):
+    # The keys are encoded once, rather than for every row.
+    prefixes = [ ("," if i else "{") + encode_json(name) + ":" for (i, (name, type)) in enumerate(columns) ]
+    count = 0
+    for row in c:
+        f.write("".join(prefix + encode_json(value) for (prefix, value) in zip(prefixes, row)) + "}\n")
+        count += 1
+    return count
+
+
+def write_csv(c, table_name, columns, f):
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow([ name.encode("utf-8") for (name, type) in columns ])
+    count = 0
+    for row in c:
+        values = [ decode_value(value) for value in row ]
+        writer.writerow([ value.encode("utf-8") if isinstance(value, unicode) else value for value in values ])
+        count += 1
+    return count
+
+
+def write_columnar(c, table_name, columns, f):
+    """
+        Each column's values are spooled to a temporary file as the rows are
+        read, then the columns are copied out one after the other.
+    """
+    spools = [ tempfile.TemporaryFile() for column in columns ]
+    try:
+        count = 0
+        for row in c:
+            separator = "," if count else ""
+            for (spool, value) in zip(spools, row):
+                spool.write(separator + encode_json(value))
+            count += 1
+
+        f.write('{"table":%s,"rows":%d,"columns":[' % (encode_json(table_name), count))
+        f.write(",".join('{"name":%s,"type":"%s"}' % (encode_json(name), type) for (name, type) in columns))
+        f.write('],"data":[')
+        for (i, spool) in enumerate(spools):
+            f.write("," if i else "")
+            f.write("[")
+            spool.seek(0)
+            for block in iter(lambda: spool.read(65536), ""):
+                f.write(block)
+            f.write("]")
+        f.write("]}\n")
+    finally:
+        for spool in spools:
+            spool.close()
+    return count
+
+
+format_writers = {
+    "ndjson":   (write_ndjson, ".ndjson"),
+    "csv":      (write_csv, ".csv"),
+    "columnar": (write_columnar, ".columns.json"),
+}
+
+
+def export_table(args):
+    """Export one table, returning (table name, rows, bytes, file name, seconds)."""
+    database_path, table_name, output_path, export_format, compress = args
+    start_time = time.time()
+    writer, extension = format_writers[export_format]
+    file_path = os.path.join(output_path, table_name + extension)
+
+    conn = sqlite3.connect(database_path)
+    try:
+        c = conn.cursor()
+        columns = table_columns(c, table_name)
+        c.execute("SELECT %s FROM \"%s\" ORDER BY rowid" % (", ".join("\"%s\"" % name for (name, type) in columns), table_name))
+        f = open_output(file_path, compress)
+        try:
+            count = writer(c, table_name, columns, f)
+        finally:
+            f.close()
+    finally:
+        conn.close()
+
+    if compress:
+        file_path += ".gz"
+    return table_name, count, os.path.getsize(file_path), os.path.basename(file_path), time.time() - start_time
+
+
+def write_index_entry(f, separator, name, ids):
+    f.write(separator + encode_json(name) +":"+ json_encoder.encode(ids[0] if len(ids) == 1 else ids))
+
+
+def write_index(c, table_names, f):
+    """
+        Stream the name to id mapping of each table.  The rows are read in
+        name order, so rows which share a name can be gathered into a list
+        without holding the rest of the table in memory.
+    """
+    f.write("{")
+    first_table = True
+    for table_name in table_names:
+        column_names = [ name for (name, type) in table_columns(c, table_name) ]
+        if "id" not in column_names or "name" not in column_names:
+            continue
+        f.write("" if first_table else ",\n")
+        f.write(encode_json(table_name) +":{")
+        first_table = False
+
+        c.execute("SELECT name, id FROM \"%s\" WHERE name IS NOT NULL ORDER BY name, id" % table_name)
+        separator, current_name, ids = "", None, []
+        for (name, id) in c:
+            if ids and name != current_name:
+                write_index_entry(f, separator, current_name, ids)
+                separator, ids = ",", []
+            current_name = name
+            ids.append(id)
+        if ids:
+            write_index_entry(f, separator, current_name, ids)
+        f.write("}")
+    f.write("}\n")
+
+
+def run(table_names, export_format=DEFAULT_EXPORT_FORMAT, output_path=EXPORT_DIR_NAME, compress=False, jobs=1, index=False):
+    if not os.path.exists(DATABASE_FILENAME):
+        raise Exception, "database %s not found" % DATABASE_FILENAME
+    database_path = os.path.abspath(DATABASE_FILENAME)
+
+    conn = sqlite3.connect(database_path)
+    c = conn.cursor()
+    available_table_names = export_tables(c)
+    if not table_names:
+        table_names = available_table_names
+    for table_name in table_names:
+        if table_name not in available_table_names:
+            raise Exception, "unknown table %s" % table_name
+
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    start_time = time.time()
+    sys.stdout.write("%-36s %10s %12s  %s%s" % ("table", "rows", "bytes", "file", os.linesep))
+    task_args = [ (database_path, table_name, output_path, export_format, compress) for table_name in table_names ]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.imap_unordered(export_table, task_args)
+            for result in results:
+                sys.stdout.write("%-36s %10d %12d  %s%s" % (result[:4] + (os.linesep,)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in task_args:
+            result = export_table(args)
+            sys.stdout.write("%-36s %10d %12d  %s%s" % (result[:4] + (os.linesep,)))
+
+    if index:
+        file_path = os.path.join(output_path, INDEX_FILENAME)
+        f = open_output(file_path, compress)
+        try:
+            write_index(c, table_names, f)
+        finally:
+            f.close()
+        sys.stdout.write("%s written%s" % (INDEX_FILENAME + (".gz" if compress else ""), os.linesep))
+    conn.close()
+
+    sys.stdout.write("%d tables exported in %0.3fs%s" % (len(table_names), time.time() - start_time, os.linesep))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export tables from the DND35 SQLite database to files.")
+    parser.add_argument("tables", nargs="*", metavar="TABLE",
+        help="the tables to export (default: all tables with data)")
+    parser.add_argument("-f", "--format", choices=EXPORT_FORMATS, default=DEFAULT_EXPORT_FORMAT,
+        help="file format the tables are written in (default: %s)" % DEFAULT_EXPORT_FORMAT)
+    parser.add_argument("-o", "--output", metavar="DIR", default=EXPORT_DIR_NAME,
+        help="directory the files are written to (default: %s)" % EXPORT_DIR_NAME)
+    parser.add_argument("-z", "--gzip", action="store_true",
+        help="compress each file with gzip")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of worker processes tables are exported in (default: 1)")
+    parser.add_argument("-i", "--index", action="store_true",
+        help="also write %s, mapping row names to ids" % INDEX_FILENAME)
+    options = parser.parse_args()
+
+    run(options.tables, options.format, options.output, options.gzip, max(1, options.jobs), options.index)
@@ -0,0 +1,276 @@
+"""
+LICENSE
+
+    pysrd - Python scripts for working with the DND35 OGL SRD.
+    Copyright (C) 2012, 2013 Richard Tew
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+OVERVIEW
+
+    Replays logs of requests against a running run-webserver.py, and reports
+    the throughput and the latency percentiles of the responses.
+
+    A log has a JSON object on each line, with the "path" and "query" of a
+    request.  The access log run-webserver.py writes with --access-log is in
+    this form, so logs are recorded by running the server with it, and any
+    other fields of the lines are ignored.  A request which was answered
+    compressed is replayed asking for the same compression.
+
+    The requests are sent from a number of client threads, each taking the
+    next request of the log in turn, and the log is replayed as many times
+    as needed to send the number of requests asked for.  Each client sends
+    its requests over one keep-alive connection, unless told not to.
+
+    Command line options:
+        LOG ..:             The logs to replay, one after the other.
+        --host ADDRESS:     Address of the server (default: 127.0.0.1).
+        --port N:           Port of the server (default: 9000).
+        --concurrency N:    Number of client threads (default: 8).
+        --requests N:       Requests to send (default: each one in the logs
+                            once).
+        --no-keep-alive:    Open a new connection for every request.
+        --record FILE:      Also write a line to FILE for each response, in
+                            the form of the access log, so a replay can
+                            itself be replayed.
+        --report FILE:      Also write the results to FILE as JSON.
+"""
+
+import argparse
+import collections
+import httplib
+import json
+import os
+import socket
+import sys
+import threading
+import timeit
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9000
+DEFAULT_CONCURRENCY = 8
+# Seconds to wait on the server, before a request is counted as failed.
+REQUEST_TIMEOUT = 60.0
+
+# The latency percentiles reported.
+percentiles = [ 50, 95, 99 ]
+
+timer = timeit.default_timer
+
+
+def read_logs(file_names):
+    """A list of (path, query, encoding) for the requests in the logs."""
+    entries = []
+    for file_name in file_names:
+        with open(file_name, "r") as f:
+            for (line_number, line) in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    raise Exception, "%s line %d: not a JSON object" % (file_name, line_number + 1)
+                if not isinstance(entry, dict) or "path" not in entry:
+                    raise Exception, "%s line %d: no request path" % (file_name, line_number + 1)
+                entries.append((str(entry["path"]), str(entry.get("query") or ""), entry.get("encoding")))
+    return entries
+
+
+def percentile(sorted_values, percent):
+    # The nearest rank, so the value is one which was actually measured.
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(percent / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Replay(object):
+    """
+        Sends the requests from the client threads, and gathers the latency,
+        status and size of each response.
+    """
+
+    def __init__(self, host, port, entries, request_count, keep_alive, record_file=None):
+        self.host = host
+        self.port = port
+        self.entries = entries
+        self.request_count = request_count
+        self.keep_alive = keep_alive
+        self.record_file = record_file
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(int)
+        self.response_bytes = 0
+        self.errors = 0
+
+    def take_request(self):
+        with self.lock:
+            if self.next_index >= self.request_count:
+                return None
+            entry = self.entries[self.next_index % len(self.entries)]
+            self.next_index += 1
+            return entry
+
+    def send(self, conn, path, query, encoding):
+        headers = {}
+        if encoding is not None:
+            headers["Accept-Encoding"] = encoding
+        if not self.keep_alive:
+            headers["Connection"] = "close"
+        conn.request("GET", path + ("?"+ query if query else ""), headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        if response.will_close:
+            conn.close()
+        return response.status, len(body)
+
+    def run_client(self):
+        conn = None
+        while True:
+            entry = self.take_request()
+            if entry is None:
+                break
+            path, query, encoding = entry
+            if conn is None or not self.keep_alive:
+                conn = httplib.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT)
+
+            start_time = timer()
+            try:
+                status, size = self.send(conn, path, query, encoding)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                conn = None
+                with self.lock:
+                    self.errors += 1
+                continue
+            latency = timer() - start_time
+
+            with self.lock:
+                self.latencies[path].append(latency)
+                self.statuses[status] += 1
+                self.response_bytes += size
+                if self.record_file is not None:
+                    self.record_file.write(json.dumps({ "path": path, "query": query, "status": status,
+                        "bytes": size, "seconds": round(latency, 6), "encoding": encoding }, sort_keys=True) +"\n")
+        if conn is not None:
+            conn.close()
+
+    def run(self, concurrency):
+        """Send all the requests, returning the seconds it took."""
+        threads = [ threading.Thread(target=self.run_client) for i in range(concurrency) ]
+        start_time = timer()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # A timeout keeps the main thread responsive to KeyboardInterrupt.
+            while thread.is_alive():
+                thread.join(1.0)
+        return timer() - start_time
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    summary = { "requests": len(latencies), "max": latencies[-1] if latencies else 0.0 }
+    for percent in percentiles:
+        summary["p%d" % percent] = percentile(latencies, percent)
+    return summary
+
+
+def write_summary_line(name, summary):
+    sys.stdout.write("%-24s %8d %s %9.2fms%s" % (name, summary["requests"],
+        " ".join("%9.2fms" % (summary["p%d" % percent] * 1000.0) for percent in percentiles),
+        summary["max"] * 1000.0, os.linesep))
+
+
+def run(log_file_names, host=DEFAULT_HOST, port=DEFAULT_PORT, concurrency=DEFAULT_CONCURRENCY,
+        request_count=None, keep_alive=True, record_path=None, report_path=None):
+    entries = read_logs(log_file_names)
+    if not entries:
+        raise Exception, "no requests in %s" % ", ".join(log_file_names)
+    if request_count is None:
+        request_count = len(entries)
+
+    record_file = open(record_path, "w") if record_path is not None else None
+    try:
+        replay = Replay(host, port, entries, request_count, keep_alive, record_file)
+        sys.stdout.write("Replaying %d requests to %s port %d from %d clients%s%s" % (request_count, host, port,
+            concurrency, "" if keep_alive else " without keep-alive", os.linesep))
+        elapsed_time = replay.run(concurrency)
+    finally:
+        if record_file is not None:
+            record_file.close()
+
+    completed = sum(len(latencies) for latencies in replay.latencies.values())
+    sys.stdout.write("%d responses, %d errors in %0.3fs: %0.1f requests/s, %0.2f MB/s%s" % (completed,
+        replay.errors, elapsed_time, completed / elapsed_time,
+        replay.response_bytes / (1024.0 * 1024.0) / elapsed_time, os.linesep))
+    sys.stdout.write("status %s%s" % (", ".join("%d: %d" % item for item in sorted(replay.statuses.items())), os.linesep))
+
+    sys.stdout.write("%-24s %8s %s %11s%s" % ("path", "requests",
+        " ".join("%11s" % ("p%d" % percent) for percent in percentiles), "max", os.linesep))
+    all_latencies = []
+    paths = {}
+    for (path, latencies) in sorted(replay.latencies.items()):
+        paths[path] = latency_summary(latencies)
+        write_summary_line(path, paths[path])
+        all_latencies.extend(latencies)
+    total = latency_summary(all_latencies)
+    write_summary_line("all", total)
+
+    if report_path is not None:
+        report = {
+            "host": host,
+            "port": port,
+            "concurrency": concurrency,
+            "keep_alive": keep_alive,
+            "seconds": elapsed_time,
+            "errors": replay.errors,
+            "bytes": replay.response_bytes,
+            "requests_per_second": completed / elapsed_time,
+            "statuses": dict((str(status), count) for (status, count) in replay.statuses.items()),
+            "latency": total,
+            "paths": paths,
+        }
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay logged requests against run-webserver.py.")
+    parser.add_argument("logs", nargs="+", metavar="LOG",
+        help="logs of requests, a JSON object with a path and query on each line")
+    parser.add_argument("--host", default=DEFAULT_HOST,
+        help="address of the server (default: %s)" % DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+        help="port of the server (default: %d)" % DEFAULT_PORT)
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+        help="number of client threads (default: %d)" % DEFAULT_CONCURRENCY)
+    parser.add_argument("-n", "--requests", type=int,
+        help="requests to send, repeating the logs as needed (default: each logged request once)")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false",
+        help="open a new connection for every request")
+    parser.add_argument("--record", metavar="FILE",
+        help="also write a line of JSON to FILE for each response")
+    parser.add_argument("-r", "--report", metavar="FILE",
+        help="also write the results to FILE as JSON")
+    options = parser.parse_args()
+
+    request_count = max(1, options.requests) if options.requests is not None else None
+    run(options.logs, options.host, options.port, max(1, options.concurrency), request_count,
+        options.keep_alive, options.record, options.report)
@@ -24,26 +24,101 @@ OVERVIEW
     parses additional SRD information from Josh Ritter's OpenSRD
     (http://sourceforge.net/projects/opensrd) HTML files.
 
+    The database is rebuilt in a copy, BUILD_DATABASE_FILENAME, which has the
+    name and display columns indexed and is analyzed and vacuumed, before it
+    atomically replaces DATABASE_FILENAME.  Readers of the database never see
+    a partially built one.  If nothing needed to be rebuilt, the database is
+    left as it was.  A running run-webserver.py notices the new database and
+    reopens it, except on Windows, where a file cannot be replaced while
+    SQLite has it open, and the webserver must be stopped for the rebuild.
+
     You will need to ensure the following variables have the correct values:
         DATABASE_FILENAME:  Name of a local file containing the SQLite database
                             created by highmage.
         HTML_DIR_NAME:      Name of local directory immediately containing the
                             OpenSRD html files.
 
+    Tables within the html files are extracted into custom tables as well.
+    Those listed in table_specs get specific treatment, and every other table
+    goes into a table named after its file and the heading it follows, such
+    as "html_barbarian_the_barbarian".
+
+    The html text of every table that has any, custom or otherwise, is
+    indexed for full text search in the "search_index" FTS5 table.
+
     Additionally, generally unparseable data is hard-coded into a secondary
-    script and will be injected directly into custom tables.
+    script, STATIC_DATA_FILENAME, and is injected directly into the tables
+    once they are built.  Each statement in it must be an INSERT, REPLACE,
+    UPDATE or DELETE of one of the custom tables, and the whole script is
+    run in the same transaction as the rest of the build.  It is only run
+    again when it changes, or when a table it injects into is rebuilt.  A
+    change rebuilds the custom tables it injects into.  The andargor tables
+    are never rebuilt, so the script cannot inject into them.
+
+    Command line options:
+        --jobs N:           Parse and extract the html files in N worker
+                            processes.  The database is only ever written by
+                            the main process, and the output is the same for
+                            any number of jobs.
+        --force:            Rebuild every custom table.  Otherwise tables whose
+                            source html file and extractor version match those
+                            recorded in the build_manifest table are skipped.
+        --parser NAME:      The html parser bs4 uses, one of "lxml" (the
+                            default and fastest), "html5lib" or "html.parser".
+        --compare-parsers:  Time every installed html parser, and check that
+                            they all extract identical rows.
+        --report FILE:      Write the timings of each stage of the build to
+                            FILE as JSON, in addition to the summary shown.
+        --fulltext-storage STORAGE:
+                            How html text is stored.  "pretty" (the default)
+                            is indented, "compact" has whitespace collapsed,
+                            and "compressed" is compact, with larger entries
+                            stored as zlib compressed UTF-8 BLOBs.
 """
 
+import argparse
 import bs4 # c:\python27\Scripts\pip.exe install beautifulsoup4
+import copy
+import ctypes
+import hashlib
+import HTMLParser
+import json
+import multiprocessing
 import os
 import re
+import shutil
 import sys
-import StringIO
 import sqlite3
+import timeit
+import zlib
+
+from srd_tables import data_table_names, decode_fulltext, table_display_columns, table_sort_column
 
 
 DATABASE_FILENAME = "dnd35.sqlite"
 HTML_DIR_NAME = "SRD-html"
+STATIC_DATA_FILENAME = "srd_static_data.sql"
+# Builds are made in a copy of the database, which then replaces it.
+BUILD_DATABASE_FILENAME = DATABASE_FILENAME +".build"
+
+# The tree builders bs4 can parse the html files with.  The choice is always
+# explicit, as each parses the messier parts of the html differently.
+HTML_PARSERS = [ "lxml", "html5lib", "html.parser" ]
+DEFAULT_HTML_PARSER = "lxml"
+# Earlier versions of bs4 share the attributes and children of a copied tag
+# with the original, and the extractors would then modify the shared tree.
+MIN_BS4_VERSION = (4, 4)
+
+# How the html text in fulltext columns is stored.  "pretty" is the indented
+# output of bs4, "compact" has whitespace collapsed instead, and "compressed"
+# is compact with the larger entries stored as zlib compressed UTF-8 BLOBs.
+FULLTEXT_STORAGES = [ "pretty", "compact", "compressed" ]
+DEFAULT_FULLTEXT_STORAGE = "pretty"
+# Entries smaller than this many bytes are not worth compressing.
+COMPRESS_MIN_SIZE = 256
+
+# The storage html text is rendered for by the extractors in this process.
+fulltext_storage = DEFAULT_FULLTEXT_STORAGE
 
 
 # Taken from the Python wiki.
@@ -72,199 +147,468 @@ def escape_children(v):
             child.replace_with(html_escape(child))
 
 
+def strip_class(v):
+    if "class" in v.attrs:
+        del v.attrs["class"]
+
+
+whitespace_re = re.compile(u"[ \t\r\n]+")
+
+
+def render_html(v):
+    """Render the tag as html text, in the current fulltext storage style."""
+    if fulltext_storage == "pretty":
+        return v.prettify()
+    return whitespace_re.sub(u" ", unicode(v))
+
+
+def check_bs4_version():
+    version = tuple(int(bit) for bit in re.findall("[0-9]+", bs4.__version__)[:2])
+    if version < MIN_BS4_VERSION:
+        raise Exception, "bs4 %s is installed, but %d.%d or later is needed" % ((bs4.__version__,) + MIN_BS4_VERSION)
+
+check_bs4_version()
+
+
+def render_copy(v, modify):
+    """
+        Render a modified copy of the tag, leaving the shared document tree
+        untouched.  The text is the same as modifying and rendering in place.
+    """
+    v_copy = copy.copy(v)
+    modify(v_copy)
+    text = render_html(v_copy)
+    # A detached copy has no next sibling, so bs4 omits the trailing newline.
+    if fulltext_storage == "pretty" and v.next_sibling is not None:
+        text += "\n"
+    return text
+
+
+class DocumentCache(object):
+    """
+        Parsed OpenSRD html files, keyed by file name.  Each file is read and
+        parsed at most once per run, and the resulting document tree is shared
+        by every extractor that walks it.  Extractors must not modify it.
+    """
+
+    def __init__(self, html_path, parser=DEFAULT_HTML_PARSER, profile=None):
+        self.html_path = html_path
+        self.parser = parser
+        self.profile = profile
+        self.documents = {}
+
+    def get(self, file_name):
+        soup = self.documents.get(file_name)
+        if soup is None:
+            start_time = timer()
+            file_path = os.path.join(self.html_path, file_name)
+            with open(file_path, "r") as f:
+                data = f.read()
+            read_time = timer()
+            soup = self.documents[file_name] = bs4.BeautifulSoup(data, self.parser)
+            if self.profile is not None:
+                self.profile.add_file(file_name, len(data), read_time - start_time, timer() - read_time)
+        return soup
+
+
 #####
+# Build profiling.
 
-def parse_special_abilities(cb):
-    file_path = os.path.join(html_path, "abilitiesAndConditions.html")
-    with open(file_path, "r") as f:
-        soup = bs4.BeautifulSoup(f)
-        v = first_h5 = soup.body.h5
-
-        name = ""
-        fulltext = ""
-        while v:
-            if isinstance(v, bs4.Tag):
-                if v.name == "h5":
-                    # Commit any current entry.
-                    if name:
-                        for name in name.split("and"):
-                            cb(name=name.strip().capitalize(), fulltext=fulltext)
-                    # Start the next entry.
-                    name = v.get_text().lower()
-                    fulltext = ""
-                elif v.name == "h3":
-                    break
-                else:
-                    if "class" in v.attrs:
-                        del v.attrs["class"]
-                    fulltext += v.prettify()
+timer = timeit.default_timer
+
+
+class BuildProfile(object):
+    """
+        Timings for each stage of a build.  Html files have their size, read
+        and parse times, extractors their extraction time, and the tables
+        they produce their row count and load time.  Each pass of the build
+        has its overall time.  Worker processes profile the files they handle,
+        and their profiles are merged into that of the build.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.extractors = {}
+        self.tables = {}
+        self.passes = []
+
+    def add_file(self, file_name, size, read_time, parse_time):
+        self.files[file_name] = { "bytes": size, "read": read_time, "parse": parse_time }
+
+    def add_extractor(self, name, file_name, extract_time):
+        # Extractors which were up to date have no extraction time.
+        self.extractors[name] = { "file": file_name, "extract": extract_time, "tables": [] }
+
+    def add_table(self, table_name, extractor_name, rows, load_time):
+        self.tables[table_name] = { "extractor": extractor_name, "rows": rows, "load": load_time }
+        self.extractors[extractor_name]["tables"].append(table_name)
+
+    def add_pass(self, name, elapsed_time):
+        self.passes.append((name, elapsed_time))
+
+    def merge(self, other):
+        self.files.update(other.files)
+        self.extractors.update(other.extractors)
+        self.tables.update(other.tables)
+
+    def as_dict(self):
+        return {
+            "files": self.files,
+            "extractors": self.extractors,
+            "tables": self.tables,
+            "passes": [ { "name": name, "seconds": elapsed_time } for (name, elapsed_time) in self.passes ],
+        }
+
+    def write_summary(self, f, extractor_names):
+        f.write("%-40s %10s %8s %8s%s" % ("file", "bytes", "read", "parse", os.linesep))
+        for file_name in sorted(self.files):
+            entry = self.files[file_name]
+            f.write("%-40s %10d %7.3fs %7.3fs%s" % (file_name, entry["bytes"], entry["read"], entry["parse"], os.linesep))
+        f.write(os.linesep)
+
+        f.write("%-40s %6s %8s %8s %8s%s" % ("extractor", "tables", "rows", "extract", "load", os.linesep))
+        for name in extractor_names:
+            entry = self.extractors.get(name)
+            if entry is None:
+                continue
+            if entry["extract"] is None:
+                f.write("%-40s unchanged%s" % (name, os.linesep))
+                continue
+            tables = [ self.tables[table_name] for table_name in entry["tables"] ]
+            f.write("%-40s %6d %8d %7.3fs %7.3fs%s" % (name, len(tables),
+                sum(table["rows"] for table in tables), entry["extract"],
+                sum(table["load"] for table in tables), os.linesep))
+        f.write(os.linesep)
+
+        for (name, elapsed_time) in self.passes:
+            f.write("%-40s %7.3fs%s" % (name, elapsed_time, os.linesep))
+
+
+#####
+
+def parse_special_abilities(soup, cb):
+    v = first_h5 = soup.body.h5
+
+    name = ""
+    fulltext = ""
+    while v:
+        if isinstance(v, bs4.Tag):
+            if v.name == "h5":
+                # Commit any current entry.
+                if name:
+                    for name in name.split("and"):
+                        cb(name=name.strip().capitalize(), fulltext=fulltext)
+                # Start the next entry.
+                name = v.get_text().lower()
+                fulltext = ""
+            elif v.name == "h3":
+                break
             else:
-                pass # print v.string
-            v = v.next_sibling
-        # Commit any current entry.
-        if name:
-            for name in name.split("and"):
-                cb(name=name.strip().capitalize(), fulltext=fulltext)
+                fulltext += render_copy(v, strip_class)
+        else:
+            pass # print v.string
+        v = v.next_sibling
+    # Commit any current entry.
+    if name:
+        for name in name.split("and"):
+            cb(name=name.strip().capitalize(), fulltext=fulltext)
 
 
-def parse_conditions(cb):
-    file_path = os.path.join(html_path, "abilitiesAndConditions.html")
-    with open(file_path, "r") as f:
-        soup = bs4.BeautifulSoup(f)
-        v  = soup.body.h3.find_next("h3")
-        if v.get_text() != "CONDITIONS":
-            raise Exception, "unable to find CONDITIONS H3 tag"
+def parse_conditions(soup, cb):
+    v  = soup.body.h3.find_next("h3")
+    if v.get_text() != "CONDITIONS":
+        raise Exception, "unable to find CONDITIONS H3 tag"
+    v = v.find_next("p")
+
+    name = ""
+    fulltext = ""
+    while v:
+        if "class" not in v.attrs:
+            b = v.find("b")
+            if b is None:
+                fulltext += render_html(v)
+            else:
+                # Commit any current entry.
+                if name:
+                    cb(name=name, fulltext=fulltext)
+                # Start the next entry.
+                name = b.get_text().lower().capitalize()
+                fulltext = render_copy(v, escape_children)
         v = v.find_next("p")
+    # Commit any current entry.
+    if name:
+        cb(name=name, fulltext=fulltext)
 
-        name = ""
-        fulltext = ""
-        while v:
-            if "class" not in v.attrs:
-                b = v.find("b")
-                if b is None:
-                    fulltext += v.prettify()
-                else:
-                    # Commit any current entry.
-                    if name:
-                        cb(name=name, fulltext=fulltext)
-                    # Start the next entry.
-                    name = b.get_text().lower().capitalize()
-                    escape_children(v)
-                    fulltext = v.prettify()
-            v = v.find_next("p")
-        # Commit any current entry.
-        if name:
-            cb(name=name, fulltext=fulltext)
-
-def parse_abilities(cb):
+def parse_abilities(soup, cb):
     title_re = re.compile("([a-zA-Z]+)[ ]+\(([a-zA-Z]+)\)")
 
-    file_path = os.path.join(html_path, "basics.html")
-    with open(file_path, "r") as f:
-        soup = bs4.BeautifulSoup(f)
-        v  = soup.body.h3.find_next("h3")
-        while v.get_text() != "THE ABILITIES":
-            v  = v.find_next("h3")
-
-        v  = v.find_next("h5")
-        name = ""
-        shortname = ""
-        fulltext = ""
-        while v:
-            if isinstance(v, bs4.Tag):
-                if v.name == "h5":
-                    # Commit any current entry.
-                    if name:
-                        cb(name=name, shortname=shortname, fulltext=fulltext)
-                    # Start the next entry.
-                    m = title_re.match(v.get_text().lower())
-                    name = m.group(1).capitalize()
-                    shortname = m.group(2)
-                    fulltext = ""
-                elif v.name == "h3":
-                    break
+    v  = soup.body.h3.find_next("h3")
+    while v.get_text() != "THE ABILITIES":
+        v  = v.find_next("h3")
+
+    v  = v.find_next("h5")
+    name = ""
+    shortname = ""
+    fulltext = ""
+    while v:
+        if isinstance(v, bs4.Tag):
+            if v.name == "h5":
+                # Commit any current entry.
+                if name:
+                    cb(name=name, shortname=shortname, fulltext=fulltext)
+                # Start the next entry.
+                m = title_re.match(v.get_text().lower())
+                name = m.group(1).capitalize()
+                shortname = m.group(2)
+                fulltext = ""
+            elif v.name == "h3":
+                break
+            else:
+                fulltext += render_copy(v, strip_class)
+        else:
+            pass # print v.string
+        v = v.next_sibling
+    # Commit any current entry.
+    if name:
+        cb(name=name, shortname=shortname, fulltext=fulltext)
+
+#####
+# Html tables.
+
+class TableSpec(object):
+    """
+        Describes how a table in an OpenSRD html file is extracted into a
+        database table.
+
+            table_name:     Name of the database table.
+            file_name:      Html file containing the table.
+            heading:        Text of the heading the table follows.
+            column_name:    Optional function mapping the index and lower-case
+                            header text of a column to a database column name.
+            column_type:    Type of every column.  If None, each column is
+                            INTEGER if all its values are, otherwise TEXT.
+            range_columns:  Header texts of the columns holding "min-max"
+                            ranges, which are split into two columns.
+            dash_value:     Value stored for cells holding only a dash.
+    """
+
+    def __init__(self, table_name, file_name, heading, column_name=None,
+            column_type=None, range_columns=(), dash_value=None):
+        self.table_name = table_name
+        self.file_name = file_name
+        self.heading = heading
+        self.column_name = column_name
+        self.column_type = column_type
+        self.range_columns = range_columns
+        self.dash_value = dash_value
+
+    def find_table(self, soup):
+        for heading in soup.find_all(heading_tag_re):
+            if cell_text(heading) == self.heading:
+                return heading.find_next("table")
+        raise Exception, "unable to find %s heading in %s" % (self.heading, self.file_name)
+
+
+heading_tag_re = re.compile("^h[1-6]$")
+dash_values = (u"\u2014", u"\u2013", u"-")
+minus_sign_re = re.compile(u"^[\u2013\u2212]")
+range_value_re = re.compile(u"^([+-]?[0-9]+)[ ]*[-\u2013\u2014][ ]*([+-]?[0-9]+)$")
+
+
+def cell_text(cell):
+    return u" ".join(cell.get_text().split())
+
+
+def cell_value(text, dash_value=None):
+    if text in dash_values:
+        return dash_value
+    try:
+        # The html often uses an en dash as a minus sign.
+        return int(minus_sign_re.sub(u"-", text))
+    except ValueError:
+        return text or None
+
+
+def range_values(value):
+    """Split a "min-max" range, or a single number, into (min, max)."""
+    if value is None or type(value) is int:
+        return value, value
+    m = range_value_re.match(value)
+    if m is None:
+        return None, None
+    return int(m.group(1)), int(m.group(2))
+
+
+def identifier(text):
+    """A lower-case database identifier derived from the given text."""
+    text = re.sub("([a-z])([A-Z])", r"\1_\2", text)
+    name = re.sub("[^a-z0-9]+", "_", text.lower()).strip("_")
+    if name[:1].isdigit():
+        name = "col_"+ name
+    return name
+
+
+def read_html_table(table):
+    """
+        Read the column names and lines of cell text from an html table.  The
+        last row made up only of header cells names the columns, or failing
+        that, the first row does.  A cell spanning several columns is read as
+        that many empty cells, and a single cell spanning the whole row is a
+        note rather than data.  Lines which do not match the columns are
+        skipped.
+    """
+    header = None
+    lines = []
+    for tr in table.find_all("tr"):
+        if tr.find_parent("table") is not table:
+            continue
+        cells = tr.find_all([ "th", "td" ], recursive=False)
+        if not cells:
+            continue
+        if all(cell.name == "th" for cell in cells):
+            header = []
+            for cell in cells:
+                if "colspan" in cell.attrs:
+                    header.extend(( "?" for i in range(int(cell.attrs["colspan"])) ))
                 else:
-                    if "class" in v.attrs:
-                        del v.attrs["class"]
-                    fulltext += v.prettify()
+                    header.append(cell_text(cell).lower())
+            continue
+        line = []
+        for cell in cells:
+            if "colspan" in cell.attrs:
+                line.extend(( None for i in range(int(cell.attrs["colspan"])) ))
             else:
-                pass # print v.string
-            v = v.next_sibling
-        # Commit any current entry.
-        if name:
-            cb(name=name, shortname=shortname, fulltext=fulltext)
-
-def parse_abilities_table(cb):
-    file_path = os.path.join(html_path, "basics.html")
-    with open(file_path, "r") as f:
-        soup = bs4.BeautifulSoup(f)
-
-        v  = soup.body.h5
-        while v.get_text() != "ABILITY MODIFIERS":
-            v = v.find_next("h5")
-
-        e = v.find_next("tr")
-        tr_column_names = []
-        tr_lines = []
-        while e:
-            if isinstance(e, bs4.Tag):
-                if e.name == "tr":
-                    if e.th is not None:
-                        # The last row with header cells is considered the right one.
-                        tr_column_names[:] = []
-                        th = e.th
-                        while th:
-                            if isinstance(th, bs4.Tag):
-                                if "colspan" in th.attrs:
-                                    colspan = int(th.attrs["colspan"])
-                                    tr_column_names.extend(( "?" for i in range(colspan) ))
-                                else:
-                                    v = th.get_text().lower()
-                                    tr_column_names.append(th.get_text().lower())
-                            th = th.next_sibling
-                    elif e.td is not None:
-                        td = e.td
-                        line = []
-                        while td:
-                            if isinstance(td, bs4.Tag):
-                                if "colspan" in td.attrs:
-                                    colspan = int(td.attrs["colspan"])
-                                    if colspan != len(tr_column_names):
-                                        line.extend(( "NULL" for i in range(colspan) ))
-                                else:
-                                    value = td.get_text()
-                                    if value == u'\u2014': # unicode for '-'
-                                        value = 0
-                                    else:
-                                        try:
-                                            value = int(value)
-                                        except ValueError:
-                                            pass
-                                    line.append(value)
-                            td = td.next_sibling
-                        if len(line) == len(tr_column_names):
-                            tr_lines.append(line)
-            elif len(e.string) > 1:
-                pass # print "'"+ e +"'"
-            e = e.next_sibling
-
-        # Translate the table column names to database column names.
-        db_column_names = []
-        column_types_list = []
-        for i, column_name in enumerate(tr_column_names):
-            if i == 0:
-                db_column_names.append(column_name +"_min")
-                column_types_list.append((db_column_names[-1], "INTEGER"))
-                db_column_names.append(column_name +"_max")
-                column_types_list.append((db_column_names[-1], "INTEGER"))
+                line.append(cell_text(cell))
+        lines.append((line, len(cells) == 1 and "colspan" in cells[0].attrs))
+
+    if header is None:
+        if not lines:
+            return [], []
+        header = [ (text or "").lower() for text in lines[0][0] ]
+        lines = lines[1:]
+    lines = [ line for (line, is_note) in lines if len(line) == len(header) and not is_note ]
+    return header, lines
+
+
+def extract_table_rows(spec, table):
+    """
+        Extract the rows of an html table as described by the spec.  Each row
+        carries the column types of the table, in column order.
+    """
+    header, lines = read_html_table(table)
+
+    # Translate the table column names to database column names.
+    db_column_names = []
+    for i, text in enumerate(header):
+        if text in spec.range_columns:
+            name = identifier(text)
+            db_column_names.extend([ name +"_min", name +"_max" ])
+        else:
+            name = spec.column_name(i, text) if spec.column_name else identifier(text)
+            db_column_names.append(name)
+
+    db_lines = []
+    for line in lines:
+        db_line = []
+        for text, value in zip(header, line):
+            value = cell_value(value, spec.dash_value) if value is not None else None
+            if text in spec.range_columns:
+                db_line.extend(range_values(value))
             else:
-                c = column_name[0]
-                try:
-                    int(column_name[0])
-                    value = "level_"+ column_name[0]
-                except ValueError:
-                    value = column_name
-                db_column_names.append(value)
-                column_types_list.append((db_column_names[-1], "INTEGER"))
-
-        # Fix the first column.
-        db_lines = []
-        for tr_line in tr_lines:
-            db_line = []
-            score_range = tr_line[0]
-            if type(score_range) is int:
-                score_min = score_max = score_range
+                db_line.append(value)
+        db_lines.append(db_line)
+
+    # Unnamed, reserved and repeated column names get unique ones.
+    used_names = set([ "id" ])
+    for i, name in enumerate(db_column_names):
+        if not name or name == "?":
+            name = "column_%d" % (i+1)
+        unique_name = name
+        suffix = 2
+        while unique_name in used_names:
+            unique_name = "%s_%d" % (name, suffix)
+            suffix += 1
+        used_names.add(unique_name)
+        db_column_names[i] = unique_name
+
+    column_types_list = []
+    for i, name in enumerate(db_column_names):
+        column_type = spec.column_type
+        if column_type is None:
+            values = [ db_line[i] for db_line in db_lines if db_line[i] is not None ]
+            if values and all(type(value) is int for value in values):
+                column_type = "INTEGER"
             else:
-                score_min, score_max = [ int(v) for v in score_range.split("-") ]
-            db_line.append(score_min)
-            db_line.append(score_max)
-            db_line.extend(tr_line[1:])
-            db_lines.append(db_line)
+                column_type = "TEXT"
+        column_types_list.append((name, column_type))
+
+    rows = []
+    for db_line in db_lines:
+        row = dict(zip(db_column_names, db_line))
+        row["column_types_list"] = column_types_list
+        rows.append(row)
+    return rows
+
+
+def table_extractor(spec):
+    """Create an extractor for the html table the spec describes."""
+    def extract(soup, cb):
+        for row in extract_table_rows(spec, spec.find_table(soup)):
+            cb(**row)
+    return extract
+
+
+def parse_html_tables(file_name, soup, cb):
+    """
+        Extract every data table in the html file that no spec already covers.
+        Each goes into its own database table, named after the file and the
+        heading the table follows, with column types taken from the values.
+    """
+    claimed_tables = set()
+    for spec in table_specs:
+        if spec.file_name == file_name:
+            claimed_tables.add(spec.find_table(soup))
+
+    file_part = identifier(os.path.splitext(file_name)[0])
+    used_table_names = set()
+    for table in soup.find_all("table"):
+        # Layout tables hold other tables, and are not data.
+        if table in claimed_tables or table.find("table") is not None:
+            continue
+        heading = table.find_previous(heading_tag_re)
+        table_name = "html_"+ file_part
+        if heading is not None:
+            heading_part = identifier(re.sub("^table:", "", cell_text(heading).lower()))
+            if heading_part:
+                table_name += "_"+ heading_part
+        rows = extract_table_rows(TableSpec(table_name, file_name, None), table)
+        if not rows or len(rows[0]["column_types_list"]) < 2:
+            continue
 
-        for db_line in db_lines:
-            kwargs = dict(zip(db_column_names, db_line))
-            kwargs["column_types_list"] = column_types_list
-            cb(**kwargs)
+        unique_table_name = table_name
+        suffix = 2
+        while unique_table_name in used_table_names:
+            unique_table_name = "%s_%d" % (table_name, suffix)
+            suffix += 1
+        used_table_names.add(unique_table_name)
+        for row in rows:
+            cb.add_row(unique_table_name, row)
+
+
+def bonus_spell_column_name(index, text):
+    # Bonus spell columns are headed by the spell level, "0", "1st", "2nd"..
+    if text[:1].isdigit():
+        return "level_"+ text[0]
+    return text
+
+
+# Html tables extracted into custom tables with specific treatment.  All other
+# tables are extracted generically by parse_html_tables.
+table_specs = [
+    TableSpec("abilities_table", "basics.html", "ABILITY MODIFIERS",
+        column_name=bonus_spell_column_name, column_type="INTEGER",
+        range_columns=("score",), dash_value=0),
+]
 
 
 # This list is used to preserve column ordering.
@@ -275,99 +619,658 @@ column_types_list = [
 ]
 
 
-def create_callback(table_name, statements):
-    def cb(**kwargs):
-        # Build the complete list of known column types for this table.
-        local_column_types_list = column_types_list[:]
-        if "column_types_list" in kwargs:
-            local_column_types_list.extend(kwargs["column_types_list"])
-            del kwargs["column_types_list"]
-        local_column_types = dict(local_column_types_list)
-        input_column_names = kwargs.keys()
-
-        # Validate text has sane values.
-        for column_name in input_column_names:
-            column_type = local_column_types[column_name]
-            if "TEXT" in column_type and "'" in kwargs[column_name]:
-                raise RuntimeError("text contains SQL quoting character")
-
-        # Build the table definition on receiving the first row to insert.
-        if not len(statements):
-            s = StringIO.StringIO()
-            # Drop the table if it already exists, to start fresh.
-            s.write("DROP TABLE IF EXISTS %s;" % table_name)
-            statements.append(s.getvalue())
-            s.close()
-
-            # Recreate the table, preserving ideal column ordering.
-            s = StringIO.StringIO()
-            s.write("CREATE TABLE %s (" % table_name)
-            s.write("id INTEGER PRIMARY KEY, ")
-            cnt = 0
-            for entry in local_column_types_list:
-                if entry[0] in input_column_names:
-                    if cnt > 0:
-                        s.write(", ")
-                    s.write("%s %s" % entry)
-                    cnt += 1
-            s.write(");")
-            statements.append(s.getvalue())
-            s.close()
-
-        nameSIO = StringIO.StringIO()
-        valueSIO = StringIO.StringIO()
-        for i, column_name in enumerate(input_column_names):
-            if i > 0:
-                nameSIO.write(", ")
-                valueSIO.write(", ")
-            nameSIO.write(column_name)
-            column_type = local_column_types[column_name]
-            if column_type.startswith("TEXT"):
-                valueSIO.write("'%s'" % kwargs[column_name])
-            elif column_type.startswith("INTEGER"):
-                valueSIO.write(str(kwargs[column_name]))
-            else:
-                raise RuntimeError("Data-type '%s' needs handling" % column_type)
-
-        s = StringIO.StringIO()
-        s.write("INSERT INTO %s (%s) VALUES (%s)" % (table_name, nameSIO.getvalue(), valueSIO.getvalue()))
-        statements.append(s.getvalue())
-        s.close()
-    return cb
-
-def run():
-    conn = sqlite3.connect(DATABASE_FILENAME)
-
-    # Pass 1: Parse HTML pages and extract data.
-    for (table_name, func) in (
-            ("conditions", parse_conditions),
-            ("special_abilities", parse_special_abilities),
-            ("abilities", parse_abilities),
-            ("abilities_table", parse_abilities_table),
-        ):
-        statements = []
-        cb = create_callback(table_name, statements)
-        func(cb)
+# Settings for the build connection.  Nothing reads the database while it is
+# being rebuilt, and an interrupted build is simply run again.
+build_pragmas = [
+    "PRAGMA journal_mode=MEMORY",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA cache_size=-65536",
+]
+
+
+def coerce_value(column_type, value):
+    """Convert an extracted value to the type of the column it is stored in."""
+    if value is None:
+        return None
+    if column_type.startswith("TEXT"):
+        return unicode(value)
+    elif column_type.startswith("INTEGER"):
+        return int(value)
+    raise RuntimeError("Data-type '%s' needs handling" % column_type)
+
+
+def compress_fulltext(value):
+    """Compress larger html text, where doing so makes it smaller."""
+    if value is not None:
+        data = value.encode("utf-8")
+        if len(data) >= COMPRESS_MIN_SIZE:
+            compressed_data = zlib.compress(data, 9)
+            if len(compressed_data) < len(data):
+                return buffer(compressed_data)
+    return value
+
+
+def load_table(c, table_name, rows, compress=False):
+    """
+        Recreate the table and insert the extracted rows into it, with one
+        parameterized statement for all of them.  If compress is set, larger
+        fulltext values are stored compressed.
+    """
+    if not rows:
+        return
+
+    # Build the complete list of known column types for this table, with
+    # those the rows give taking precedence.
+    local_column_types_list = []
+    input_column_names = set()
+    for row in rows:
+        for entry in row.get("column_types_list", ()):
+            if entry not in local_column_types_list:
+                local_column_types_list.append(entry)
+        input_column_names.update(row.iterkeys())
+    input_column_names.discard("column_types_list")
+    given_column_names = set(entry[0] for entry in local_column_types_list)
+    local_column_types_list.extend(entry for entry in column_types_list if entry[0] not in given_column_names)
+
+    # Preserve ideal column ordering.
+    table_columns = [ entry for entry in local_column_types_list if entry[0] in input_column_names ]
+    column_names = [ column_name for (column_name, column_type) in table_columns ]
+    unknown_column_names = input_column_names.difference(column_names)
+    if unknown_column_names:
+        raise RuntimeError("No data-type for columns: %s" % ", ".join(sorted(unknown_column_names)))
+
+    # Drop the table if it already exists, to start fresh.
+    c.execute("DROP TABLE IF EXISTS %s" % table_name)
+    c.execute("CREATE TABLE %s (id INTEGER PRIMARY KEY, %s)" % (table_name,
+        ", ".join("\"%s\" %s" % entry for entry in table_columns)))
+    column_converters = []
+    for (column_name, column_type) in table_columns:
+        if compress and column_name == "fulltext":
+            column_converters.append(lambda value, column_type=column_type: compress_fulltext(coerce_value(column_type, value)))
+        else:
+            column_converters.append(lambda value, column_type=column_type: coerce_value(column_type, value))
+    c.executemany("INSERT INTO %s (%s) VALUES (%s)" % (table_name,
+        ", ".join("\"%s\"" % column_name for column_name in column_names),
+        ", ".join("?" for column_name in column_names)),
+        ( [ convert(row.get(column_name)) for (column_name, convert) in zip(column_names, column_converters) ]
+            for row in rows ))
+
+
+class RowCollector(object):
+    """
+        The callback given to an extractor, which gathers the rows it produces
+        as plain keyword dictionaries.  Calling it adds a row to the table
+        named after the extractor, and add_row adds one to any other table.
+        Tables are listed in the order they are first given rows.
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.tables = []
+        self.rows_by_table_name = {}
+
+    def __call__(self, **kwargs):
+        self.add_row(self.table_name, kwargs)
+
+    def add_row(self, table_name, row):
+        rows = self.rows_by_table_name.get(table_name)
+        if rows is None:
+            rows = self.rows_by_table_name[table_name] = []
+            self.tables.append((table_name, rows))
+        rows.append(row)
+
+
+# The custom tables, in the order they are built, with the html file each is
+# extracted from.  Extractors sharing a file also share its parsed document.
+# Increase the version of an extractor whenever its output changes, so that
+# incremental builds know to rebuild its table.
+extractors = [
+    ("conditions",          "abilitiesAndConditions.html",  parse_conditions,           1),
+    ("special_abilities",   "abilitiesAndConditions.html",  parse_special_abilities,    1),
+    ("abilities",           "basics.html",                  parse_abilities,            1),
+] + [
+    (spec.table_name,       spec.file_name,                 table_extractor(spec),      1)
+    for spec in table_specs
+]
+
+# The version of parse_html_tables, which also depends on table_specs.
+HTML_TABLES_VERSION = 1
+
+
+def html_tables_extractor(file_name):
+    return lambda soup, cb: parse_html_tables(file_name, soup, cb)
+
+
+def get_extractors(html_path):
+    """
+        The custom table extractors, followed by one for the remaining tables
+        in each html file.
+    """
+    result = extractors[:]
+    for file_name in sorted(os.listdir(html_path)):
+        if file_name.endswith(".html"):
+            result.append(("%s tables" % file_name, file_name, html_tables_extractor(file_name), HTML_TABLES_VERSION))
+    return result
+
+
+def source_file_names(extractor_list, names):
+    """The distinct source html files of the named extractors, in build order."""
+    file_names = []
+    for (name, file_name, func, version) in extractor_list:
+        if name in names and file_name not in file_names:
+            file_names.append(file_name)
+    return file_names
+
+
+def extract_source(documents, file_name, names, storage):
+    """
+        Run the named extractors for the given html file, rendering html text
+        for the given fulltext storage.  The result maps each extractor name
+        to the (table name, rows) pairs it produced.
+    """
+    global fulltext_storage
+    fulltext_storage = storage
+
+    result = {}
+    for (name, source_name, func, version) in get_extractors(documents.html_path):
+        if source_name == file_name and name in names:
+            soup = documents.get(file_name)
+            start_time = timer()
+            cb = RowCollector(name)
+            func(soup, cb)
+            result[name] = cb.tables
+            if documents.profile is not None:
+                documents.profile.add_extractor(name, file_name, timer() - start_time)
+    return result
+
+
+def extract_source_worker(args):
+    # Runs in a pool process, which parses its own copy of the document.
+    html_path, parser, storage, file_name, names = args
+    profile = BuildProfile()
+    return extract_source(DocumentCache(html_path, parser, profile), file_name, names, storage), profile
+
+
+def extract_all(html_path, parser, storage, jobs, names, profile=None):
+    """
+        Run the named extractors, optionally spreading the source files over a
+        pool of worker processes.  Results are gathered in source file order,
+        so the output does not depend on the number of jobs.
+    """
+    file_names = source_file_names(get_extractors(html_path), names)
+    result = {}
+    if jobs > 1 and len(file_names) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(file_names)))
+        try:
+            results = pool.map(extract_source_worker,
+                [ (html_path, parser, storage, file_name, names) for file_name in file_names ], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for (file_result, file_profile) in results:
+            result.update(file_result)
+            if profile is not None:
+                profile.merge(file_profile)
+    else:
+        documents = DocumentCache(html_path, parser, profile)
+        for file_name in file_names:
+            result.update(extract_source(documents, file_name, names, storage))
+    return result
+
+
+#####
+
+def file_hash(file_path):
+    h = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(65536), ""):
+            h.update(block)
+    return h.hexdigest()
+
+
+manifest_columns = [
+    ("extractor",           "TEXT PRIMARY KEY"),
+    ("source_hash",         "TEXT NOT NULL"),
+    ("extractor_version",   "INTEGER NOT NULL"),
+    ("parser",              "TEXT NOT NULL"),
+    ("storage",             "TEXT NOT NULL"),
+    ("tables",              "TEXT NOT NULL"),
+]
+
+
+def read_manifest(c):
+    """
+        The manifest records what each extractor last built its tables from,
+        mapping extractor name to ((source hash, extractor version, parser,
+        fulltext storage), table names).  A manifest written with different columns is
+        discarded, which in turn rebuilds every table.
+    """
+    c.execute("PRAGMA table_info(build_manifest)")
+    if [ row[1] for row in c ] != [ entry[0] for entry in manifest_columns ]:
+        c.execute("DROP TABLE IF EXISTS build_manifest")
+        c.execute("CREATE TABLE build_manifest (%s)" % ", ".join("%s %s" % entry for entry in manifest_columns))
+    c.execute("SELECT %s FROM build_manifest" % ", ".join(entry[0] for entry in manifest_columns))
+    return dict((row[0], (tuple(row[1:-1]), [ s for s in row[-1].split(",") if s ])) for row in c)
+
+
+def write_manifest(c, name, entry, table_names):
+    c.execute("INSERT OR REPLACE INTO build_manifest (%s) VALUES (%s)" % (
+        ", ".join(column[0] for column in manifest_columns), ", ".join("?" for column in manifest_columns)),
+        (name,) + entry + (",".join(table_names),))
+
+
+def stale_extractors(c, html_path, parser, storage, force=False, rebuild_table_names=()):
+    """
+        Work out which extractors need to be run.  An extractor is up to date
+        if all the tables it built still exist, and its source html file,
+        version, html parser and fulltext storage match those it last built
+        them with, and it did not build any of rebuild_table_names.  The
+        result maps the name of each extractor to run to the manifest entry
+        it should be recorded with, and the tables it previously built.
+    """
+    manifest = read_manifest(c)
+    c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    existing_table_names = set(row[0] for row in c)
+
+    file_hashes = {}
+    result = {}
+    for (name, file_name, func, version) in get_extractors(html_path):
+        if file_name not in file_hashes:
+            file_hashes[file_name] = file_hash(os.path.join(html_path, file_name))
+        entry = (file_hashes[file_name], version, parser, storage)
+        built_entry, built_table_names = manifest.get(name, (None, []))
+        if force or built_entry != entry or not existing_table_names.issuperset(built_table_names) \
+                or set(built_table_names).intersection(rebuild_table_names):
+            result[name] = entry, built_table_names
+    return result
+
+
+#####
+# Hard-coded data.
+
+# The name the static data is recorded under in the manifest.
+STATIC_DATA_NAME = "static data"
+STATIC_DATA_VERSION = 1
+
+sql_comment_re = re.compile(r"\A\s*(?:/\*.*?\*/|--[^\n]*(?:\n|\Z))", re.DOTALL)
+static_statement_re = re.compile(
+    r"\A\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)"
+    r"\s+[\"`\[]?(\w+)[\"`\]]?", re.IGNORECASE)
+
+
+def strip_sql_comments(sql):
+    """The SQL with any leading comments removed."""
+    match = sql_comment_re.match(sql)
+    while match:
+        sql = sql[match.end():]
+        match = sql_comment_re.match(sql)
+    return sql.strip()
+
+
+def read_static_data(file_path):
+    """
+        Split the script into its statements, returning a list of (line
+        number, table name, statement).  Statements which do not inject data
+        into a named table are rejected.
+    """
+    result = []
+    statement = ""
+    statement_line_number = 1
+    with open(file_path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if not strip_sql_comments(statement):
+                statement_line_number = line_number
+            statement += line
+            if not sqlite3.complete_statement(statement):
+                continue
+            sql = strip_sql_comments(statement)
+            statement = ""
+            match = static_statement_re.match(sql)
+            if match is None:
+                raise Exception, "%s:%d: only INSERT, REPLACE, UPDATE and DELETE statements are allowed" % (file_path, statement_line_number)
+            result.append((statement_line_number, match.group(1), sql))
+    if strip_sql_comments(statement):
+        raise Exception, "%s:%d: incomplete statement" % (file_path, statement_line_number)
+    return result
+
+
+def inject_static_data(c, file_path, statements):
+    """
+        Validate the statements against the custom tables the extractors
+        built, then run them in the current transaction.  Returns the number
+        of rows changed.
+    """
+    # Only tables the extractors build can be rebuilt to take injected rows out again.
+    table_names = set()
+    for (name, (entry, built_table_names)) in read_manifest(c).items():
+        if name != STATIC_DATA_NAME:
+            table_names.update(built_table_names)
+    existing_table_names = set(data_tables(c))
+    for (line_number, table_name, sql) in statements:
+        if table_name not in existing_table_names:
+            raise Exception, "%s:%d: no such table %s" % (file_path, line_number, table_name)
+        if table_name not in table_names:
+            raise Exception, "%s:%d: table %s is not built from the html files" % (file_path, line_number, table_name)
+
+    count = 0
+    for (line_number, table_name, sql) in statements:
+        try:
+            c.execute(sql)
+        except sqlite3.Error, e:
+            raise Exception, "%s:%d: %s" % (file_path, line_number, e)
+        count += c.rowcount
+    return count
+
+
+#####
+# Full text search.
+
+SEARCH_INDEX_TABLE = "search_index"
+# The andargor tables name their html column differently to the custom ones.
+fulltext_column_names = [ "fulltext", "full_text" ]
+
+tag_re = re.compile("<[^>]*>")
+html_parser = HTMLParser.HTMLParser()
+
+
+def strip_tags(text):
+    """The plain text of an html fragment, with whitespace collapsed."""
+    return u" ".join(html_parser.unescape(tag_re.sub(" ", text)).split())
+
+
+def fulltext_tables(c):
+    """
+        Find the tables with html text to index.  Each is given as its name,
+        its name column (or None), and its html column.
+    """
+    result = []
+    for table_name in data_tables(c):
+        c.execute("PRAGMA table_info(%s)" % table_name)
+        column_names = [ row[1] for row in c ]
+        if "id" not in column_names:
+            continue
+        for column_name in fulltext_column_names:
+            if column_name in column_names:
+                result.append((table_name, "name" if "name" in column_names else None, column_name))
+                break
+    return result
+
+
+def build_search_index(c):
+    """
+        Rebuild the full text search index over the html text of every table
+        which has any, with the tags stripped.  Returns the number of rows
+        indexed, or None if SQLite lacks FTS5.
+    """
+    c.execute("DROP TABLE IF EXISTS %s" % SEARCH_INDEX_TABLE)
+    try:
+        c.execute("CREATE VIRTUAL TABLE %s USING fts5(name, body, table_name UNINDEXED, row_id UNINDEXED, "
+            "tokenize='porter unicode61')" % SEARCH_INDEX_TABLE)
+    except sqlite3.OperationalError:
+        return None
+
+    count = 0
+    read_cursor = c.connection.cursor()
+    for (table_name, name_column_name, fulltext_column_name) in fulltext_tables(c):
+        read_cursor.execute("SELECT id, %s, %s FROM %s" % (name_column_name or "''", fulltext_column_name, table_name))
+        c.executemany("INSERT INTO %s (name, body, table_name, row_id) VALUES (?, ?, ?, ?)" % SEARCH_INDEX_TABLE,
+            ( (name, strip_tags(decode_fulltext(fulltext) or u""), table_name, row_id)
+                for (row_id, name, fulltext) in read_cursor ))
+        count += c.rowcount
+    read_cursor.close()
+    return count
+
+
+#####
+# Database files.
+
+def data_tables(c):
+    """The names of the tables holding data, excluding internal ones."""
+    c.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+    return data_table_names(c.fetchall())
+
+
+def create_indexes(c, display_columns, sort_columns):
+    """
+        Index the name column of every table, and the columns the webserver
+        shows and sorts it by, unless they already lead an index.  Returns
+        the number of indexes created.
+    """
+    count = 0
+    for table_name in data_tables(c):
+        c.execute("PRAGMA table_info(%s)" % table_name)
+        column_names = [ row[1] for row in c ]
+
+        indexed_column_names = set([ "id" ])
+        c.execute("PRAGMA index_list(%s)" % table_name)
+        for index_name in [ row[1] for row in c.fetchall() ]:
+            c.execute("PRAGMA index_info(\"%s\")" % index_name)
+            for (seqno, cid, column_name) in c:
+                if seqno == 0:
+                    indexed_column_names.add(column_name)
+
+        wanted_column_names = [ "name" ] + display_columns.get(table_name, []) + [ sort_columns.get(table_name) ]
+        for column_name in wanted_column_names:
+            if column_name in column_names and column_name not in indexed_column_names:
+                c.execute("CREATE INDEX \"ix_%s_%s\" ON %s (\"%s\")" % (table_name, column_name, table_name, column_name))
+                indexed_column_names.add(column_name)
+                count += 1
+    return count
+
+
+def replace_file(source_path, destination_path):
+    """Rename the source file over the destination file, atomically."""
+    if os.name == "nt":
+        # os.rename will not replace an existing file on Windows.
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        MOVEFILE_WRITE_THROUGH = 0x8
+        ERROR_ACCESS_DENIED = 5
+        ERROR_SHARING_VIOLATION = 32
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(source_path), unicode(destination_path),
+                MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            error = ctypes.GetLastError()
+            # SQLite opens files without FILE_SHARE_DELETE, so an open database cannot be replaced.
+            if error in (ERROR_ACCESS_DENIED, ERROR_SHARING_VIOLATION):
+                raise Exception, "%s is in use, stop run-webserver.py and build again" % destination_path
+            raise ctypes.WinError(error)
+    else:
+        os.rename(source_path, destination_path)
+
+
+def compare_parsers(html_path, parsers=HTML_PARSERS):
+    """
+        Run every extractor with each of the given html parsers, and check
+        they all produce the same rows as the first.  Timings are shown for
+        each, and parsers which are not installed are skipped.  Returns
+        whether the rows were identical.
+    """
+    names = [ entry[0] for entry in get_extractors(html_path) ]
+    reference_parser = reference_tables = None
+    identical = True
+    for parser in parsers:
+        try:
+            start_time = timer()
+            tables = extract_all(html_path, parser, DEFAULT_FULLTEXT_STORAGE, 1, names)
+            elapsed_time = timer() - start_time
+        except bs4.FeatureNotFound:
+            sys.stdout.write("%-12s not installed%s" % (parser, os.linesep))
+            continue
+
+        differences = []
+        if reference_tables is None:
+            reference_parser, reference_tables = parser, tables
+        else:
+            for name in names:
+                output, reference_output = dict(tables[name]), dict(reference_tables[name])
+                for table_name in sorted(set(output) | set(reference_output)):
+                    rows, reference_rows = output.get(table_name, []), reference_output.get(table_name, [])
+                    if len(rows) != len(reference_rows):
+                        differences.append("%s has %d rows, not %d" % (table_name, len(rows), len(reference_rows)))
+                        continue
+                    for i, (row, reference_row) in enumerate(zip(rows, reference_rows)):
+                        if row != reference_row:
+                            differences.append("%s row %d differs" % (table_name, i+1))
+                            break
+        identical = identical and not differences
+
+        sys.stdout.write("%-12s %8.3fs %s%s" % (parser, elapsed_time,
+            "differs from %s" % reference_parser if differences else "identical", os.linesep))
+        for difference in differences:
+            sys.stdout.write("    %s%s" % (difference, os.linesep))
+    return identical
+
+
+def run(html_path, static_data_path, parser=DEFAULT_HTML_PARSER, storage=DEFAULT_FULLTEXT_STORAGE, jobs=1, force=False, report_path=None):
+    profile = BuildProfile()
+    build_start_time = timer()
+
+    # Build in a copy, so readers of the database never see a partial build.
+    start_time = timer()
+    if os.path.exists(DATABASE_FILENAME):
+        shutil.copyfile(DATABASE_FILENAME, BUILD_DATABASE_FILENAME)
+    elif os.path.exists(BUILD_DATABASE_FILENAME):
+        os.remove(BUILD_DATABASE_FILENAME)
+    profile.add_pass("copy database", timer() - start_time)
+
+    try:
+        conn = sqlite3.connect(BUILD_DATABASE_FILENAME)
+        # Transactions are managed explicitly, so the whole build is one.
+        conn.isolation_level = None
+        for pragma in build_pragmas:
+            conn.execute(pragma)
 
         c = conn.cursor()
-        sys.stdout.write("%s %d [" % (table_name, len(statements)))
-        for s in statements:
-            sys.stdout.write(".")
-            c.execute(s)
-        sys.stdout.write("]"+ os.linesep)
+        c.execute("BEGIN")
+        try:
+            start_time = timer()
+            extractor_list = get_extractors(html_path)
+            static_statements = read_static_data(static_data_path)
+            static_entry = (file_hash(static_data_path), STATIC_DATA_VERSION, "", "")
+            static_table_names = sorted(set(entry[1] for entry in static_statements))
+            built_static_entry, built_static_table_names = read_manifest(c).get(STATIC_DATA_NAME, (None, []))
+            static_changed = force or static_entry != built_static_entry
+            # Injected rows can only be taken out again by rebuilding the tables they were put in.
+            rebuild_table_names = set(built_static_table_names + static_table_names) if static_changed else ()
+            build_entries = stale_extractors(c, html_path, parser, storage, force, rebuild_table_names)
+            profile.add_pass("check manifest", timer() - start_time)
+            modified = bool(build_entries)
+
+            # Pass 1: Parse HTML pages and extract data.
+            start_time = timer()
+            tables = extract_all(html_path, parser, storage, jobs, build_entries.keys(), profile)
+            profile.add_pass("extract", timer() - start_time)
+
+            # Only this process writes to the database.
+            start_time = timer()
+            loaded_table_names = set()
+            for (name, file_name, func, version) in extractor_list:
+                if name not in build_entries:
+                    profile.add_extractor(name, file_name, None)
+                    continue
+                entry, old_table_names = build_entries[name]
+                table_names = []
+                for (table_name, rows) in tables[name]:
+                    table_start_time = timer()
+                    load_table(c, table_name, rows, storage == "compressed")
+                    profile.add_table(table_name, name, len(rows), timer() - table_start_time)
+                    table_names.append(table_name)
+                loaded_table_names.update(table_names)
+                # Tables the extractor no longer produces are removed.
+                for table_name in old_table_names:
+                    if table_name not in table_names:
+                        c.execute("DROP TABLE IF EXISTS %s" % table_name)
+                write_manifest(c, name, entry, table_names)
+            profile.add_pass("load", timer() - start_time)
+
+            # Pass 2: Inject hard-coded data.
+            if static_changed or loaded_table_names.intersection(static_table_names):
+                start_time = timer()
+                count = inject_static_data(c, static_data_path, static_statements)
+                write_manifest(c, STATIC_DATA_NAME, static_entry, static_table_names)
+                profile.add_pass("static data (%d statements, %d rows)" % (len(static_statements), count), timer() - start_time)
+                modified = True
 
-        conn.commit()
-        c.close()
+            # Pass 3: Index the html text for searching.
+            c.execute("SELECT count(*) FROM sqlite_master WHERE name=?", (SEARCH_INDEX_TABLE,))
+            if modified or c.fetchone()[0] == 0:
+                start_time = timer()
+                count = build_search_index(c)
+                if count is None:
+                    sys.stdout.write("%s skipped, SQLite lacks FTS5%s" % (SEARCH_INDEX_TABLE, os.linesep))
+                else:
+                    profile.add_pass("search index (%d rows)" % count, timer() - start_time)
+                    modified = True
 
-    # Pass 2: Inject hard-coded data.
+            # Pass 4: Index the columns tables are looked up and sorted by.
+            if modified:
+                start_time = timer()
+                count = create_indexes(c, table_display_columns, table_sort_column)
+                profile.add_pass("indexes (%d created)" % count, timer() - start_time)
+
+            start_time = timer()
+            c.execute("COMMIT")
+            profile.add_pass("commit", timer() - start_time)
+        except:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            c.close()
+
+        if modified:
+            start_time = timer()
+            conn.execute("ANALYZE")
+            profile.add_pass("analyze", timer() - start_time)
+            start_time = timer()
+            conn.execute("VACUUM")
+            profile.add_pass("vacuum", timer() - start_time)
+        conn.close()
+
+        if modified:
+            # Make sure the build is on disk before it replaces the database.
+            start_time = timer()
+            with open(BUILD_DATABASE_FILENAME, "rb+") as f:
+                os.fsync(f.fileno())
+            replace_file(BUILD_DATABASE_FILENAME, DATABASE_FILENAME)
+            profile.add_pass("replace database", timer() - start_time)
+    finally:
+        if os.path.exists(BUILD_DATABASE_FILENAME):
+            os.remove(BUILD_DATABASE_FILENAME)
+    profile.add_pass("total", timer() - build_start_time)
+
+    profile.write_summary(sys.stdout, [ entry[0] for entry in extractor_list ])
+    if report_path is not None:
+        report = profile.as_dict()
+        report["options"] = { "parser": parser, "fulltext_storage": storage, "jobs": jobs, "force": force }
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add OpenSRD html data to the DND35 SQLite database.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of worker processes used to parse the html files (default: 1)")
+    parser.add_argument("-f", "--force", action="store_true",
+        help="rebuild every custom table, even those which are up to date")
+    parser.add_argument("-p", "--parser", choices=HTML_PARSERS, default=DEFAULT_HTML_PARSER,
+        help="html parser used by bs4 (default: %s)" % DEFAULT_HTML_PARSER)
+    parser.add_argument("-s", "--fulltext-storage", choices=FULLTEXT_STORAGES, default=DEFAULT_FULLTEXT_STORAGE,
+        help="how html text is stored (default: %s)" % DEFAULT_FULLTEXT_STORAGE)
+    parser.add_argument("-r", "--report", metavar="FILE",
+        help="write the timings of the build to FILE as JSON")
+    parser.add_argument("--compare-parsers", action="store_true",
+        help="time each html parser, and check they all extract the same rows, without building")
+    options = parser.parse_args()
+
     current_path = sys.path[0]
     html_path = os.path.join(current_path, HTML_DIR_NAME)
+    static_data_path = os.path.join(current_path, STATIC_DATA_FILENAME)
 
-    run()
+    if options.compare_parsers:
+        if not compare_parsers(html_path):
+            sys.exit(1)
+    else:
+        run(html_path, static_data_path, options.parser, options.fulltext_storage, max(1, options.jobs), options.force, options.report)
 
-    # Useful if run on Windows within explorer by double-clicking on the BAT
-    # script, and you want the window to stay open so you can inspect output.
-    raw_input("Press enter to continue..")
+        # Useful if run on Windows within explorer by double-clicking on the BAT
+        # script, and you want the window to stay open so you can inspect output.
+        raw_input("Press enter to continue..")
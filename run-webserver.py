@@ -21,51 +21,893 @@ OVERVIEW
 
     Starts up on port 9000, and allows dynamic introspection of the DND35 SQLite database contents.
 
+    Requests are served by a fixed number of worker threads.  Accepted
+    connections wait in a bounded queue for a free worker, and when the queue
+    stays full, new connections are turned away with a 503 response.  A
+    keep-alive connection holds its worker until it closes or has been idle
+    for KEEP_ALIVE_TIMEOUT seconds.
+
+    Command line options:
+        --host ADDRESS:             address to listen on (default: 127.0.0.1).
+        --port N:                   port to listen on (default: 9000).
+        --workers N:                number of worker threads (default: 8).
+        --queue N:                  connections that can wait for a worker
+                                    (default: 64).
+        --async:                    serve the connections from a single thread
+                                    with an asyncore event loop, and render the
+                                    pages in the worker threads.  Idle
+                                    keep-alive connections cost no thread.
+        --timeout N:                seconds a page can take to render before a
+                                    504 response is sent, with --async
+                                    (default: 30).
+        --access-log FILE:          append a JSON object for each request to
+                                    FILE, or write them to stdout for "-".
+        --max-body-size N:          bytes the body of a POST request can have
+                                    (default: 256MB).
+
     Hard coded variables:
 
         DATABASE_FILENAME:          file name of the DND35 SQLite database.
-        table_display_columns:      columns are explicitly excluded by table name.
-        table_sort_column:          default sorting column for specific tables.
+        DATABASE_IMMUTABLE:         open the database as immutable, so SQLite
+                                    does no locking.  It is still reopened
+                                    when the file is replaced.
+        connection_pragmas:         settings for each database connection.
+        RESPONSE_CACHE_SIZE:        bytes of rendered pages kept in memory.
+        MAX_FORM_SIZE:              bytes of a url encoded form, or of each
+                                    field of a multipart form.
+        MAX_PARTS:                  parts a multipart form can have.
+        SPOOL_SIZE:                 bytes of an uploaded file kept in memory,
+                                    before it is moved to a temporary file.
+
+    The columns shown and sorted by for specific tables are set in
+    srd_tables.py, which is shared with the other scripts.
+
+    POST request bodies, sized by Content-Length or chunked, are parsed as
+    they are read, a block at a time.  The fields of a url encoded or
+    multipart form are added to the arguments of the page, with each
+    uploaded file given as a file object, which is kept in a temporary file
+    once it is larger than SPOOL_SIZE.  Pages rendered for forms are not
+    cached.
+
+    Pages are sent gzip or deflate compressed to clients that accept either,
+    unless they are smaller than COMPRESS_MIN_SIZE bytes.
+
+    Rendered pages are cached, and sent with an ETag made from the identity
+    of the database file, so a browser asking again with If-None-Match gets
+    a 304 response until the database is rebuilt.
+
+    Pages:
+
+        /:                          list of tables.
+        /table?name=<table>:        rows of a table, a page at a time.  Also
+                                    takes sort_column, page and page_size.
+                                    Only columns leading an index can be
+                                    sorted by.
+        /row?table=<table>&row_id=<id>: all columns of a row.
+        /search?q=<words>:          ranked full text search, with snippets.
+
+    JSON API:
+
+        /api/schema:                the columns, types, row count and indexes
+                                    of every table.
+        /api/table?name=<table>:    rows of a table, a page at a time.  Also
+                                    takes columns, a comma separated list of
+                                    the columns wanted, and sort_column, page
+                                    and page_size as /table does.
+        /api/rows?table=<table>&ids=<id>,<id>..: the rows with the given ids,
+                                    in the order given, fetched in one query.
+                                    Also takes columns.  At most MAX_BATCH_IDS
+                                    ids can be asked for at once.
+
+    Errors are returned as an object with an "error" message.
+
+    Metrics:
+
+        /metrics:                   request counts by status, latency
+                                    histograms, response bytes and cache
+                                    results for each page, in the Prometheus
+                                    text format.  It is never cached.
+
+    The latency of a request is split into the time spent in SQLite, and the
+    rest, which is rendering and sending the page.  The access log lines have
+    the time, client, path, query, status, bytes, seconds, sql_seconds, cache
+    and encoding of each request.
 """
 
+import argparse
+import asynchat
+import asyncore
+import base64
+import bisect
 import cgi
+import collections
+import cStringIO
+import email.utils
+import hashlib
+import itertools
+import json
+import mimetools
+import os
+import Queue
+import select
+import signal
+import socket
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import traceback
+import urllib
 import urlparse
 import types
+import zlib
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+
+from srd_tables import data_table_names, decode_fulltext, table_display_columns, table_sort_column
 
 
 DATABASE_FILENAME = "dnd35.sqlite"
+DATABASE_IMMUTABLE = False
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9000
+DEFAULT_WORKERS = 8
+DEFAULT_QUEUE_SIZE = 64
+# Seconds a connection waits for a place in the full queue, before being turned away.
+QUEUE_TIMEOUT = 5.0
+# Seconds an idle keep-alive connection keeps its worker.
+KEEP_ALIVE_TIMEOUT = 15.0
+# Seconds a response can wait on a client to read more of it, with the asynchronous server.
+SEND_TIMEOUT = 60.0
+RESPONSE_CACHE_SIZE = 32 * 1024 * 1024
+# Bytes of a page gathered before they are sent as a chunk.
+CHUNK_SIZE = 8192
+
+# Compressions pages can be sent with, in order of preference.
+COMPRESS_ENCODINGS = [ "gzip", "deflate" ]
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+# Seconds a page can take to render, with the asynchronous server.
+DEFAULT_REQUEST_TIMEOUT = 30
+
+# Applied to each connection as it is opened.
+connection_pragmas = [
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16384",
+]
+
+# The full text search index built by run-parse-html.py.
+SEARCH_INDEX_TABLE = "search_index"
+SEARCH_RESULT_LIMIT = 100
+
+# Rows /api/rows fetches at once, kept under SQLite's limit on query parameters.
+MAX_BATCH_IDS = 500
+
+# Rows shown on each page of a table.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Limits on the bodies of POST requests.
+MAX_BODY_SIZE = 256 * 1024 * 1024
+MAX_FORM_SIZE = 1024 * 1024
+MAX_PARTS = 64
+MAX_PART_HEADER_SIZE = 16384
+MAX_LINE_SIZE = 4096
+# Bytes of an uploaded file kept in memory, before it is moved to a temporary file.
+SPOOL_SIZE = 1024 * 1024
+# Bytes of a body read at a time.
+READ_SIZE = 65536
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = [ 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 ]
+
+timer = timeit.default_timer
+
+
+class RequestTimer(threading.local):
+    """What is known about the request the calling thread is serving."""
+
+    def __init__(self):
+        # Each thread starts out with its own attributes.
+        self.reset()
+
+    def reset(self):
+        self.sql_time = 0.0
+        self.cache_result = None
+
+
+request_timer = RequestTimer()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Adds the time spent executing statements and stepping through rows to the request timer."""
+
+    def execute(self, *args):
+        start_time = timer()
+        try:
+            return sqlite3.Cursor.execute(self, *args)
+        finally:
+            request_timer.sql_time += timer() - start_time
+
+    def next(self):
+        start_time = timer()
+        try:
+            return sqlite3.Cursor.next(self)
+        finally:
+            request_timer.sql_time += timer() - start_time
+
+    def fetchone(self):
+        start_time = timer()
+        try:
+            return sqlite3.Cursor.fetchone(self)
+        finally:
+            request_timer.sql_time += timer() - start_time
+
+    def fetchall(self):
+        start_time = timer()
+        try:
+            return sqlite3.Cursor.fetchall(self)
+        finally:
+            request_timer.sql_time += timer() - start_time
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+class ConnectionPool(object):
+    """
+        Holds one read-only connection to the database for each thread that
+        uses it, which is reused across requests.  run-parse-html.py replaces
+        the database file when it rebuilds it, and when that is noticed the
+        connection is reopened on the new file.  Windows does not allow the
+        open file to be replaced, so there the server is stopped to rebuild.
+    """
+
+    def __init__(self, file_name, immutable=False):
+        self.file_name = file_name
+        self.immutable = immutable
+        self.local = threading.local()
+
+        # Python 2 can only open URI file names where SQLite was built to accept them.
+        conn = sqlite3.connect(":memory:")
+        self.use_uri = any(row[0].startswith("USE_URI") for row in conn.execute("PRAGMA compile_options"))
+        conn.close()
+
+    def file_identity(self):
+        # A replaced file has a new inode, but Windows only reports the time and size.
+        st = os.stat(self.file_name)
+        return st.st_dev, st.st_ino, st.st_mtime, st.st_size
+
+    def connect(self):
+        if self.use_uri:
+            uri = "file:%s?mode=ro" % urllib.pathname2url(os.path.abspath(self.file_name))
+            if self.immutable:
+                uri += "&immutable=1"
+            conn = sqlite3.connect(uri, factory=TimedConnection)
+        else:
+            conn = sqlite3.connect(self.file_name, factory=TimedConnection)
+            conn.execute("PRAGMA query_only=ON")
+        for pragma in connection_pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def get(self):
+        """The connection for the calling thread."""
+        try:
+            identity = self.file_identity()
+        except OSError:
+            raise Exception, "database %s not found" % self.file_name
+
+        conn = getattr(self.local, "connection", None)
+        if conn is not None and self.local.identity != identity:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self.local.connection = self.connect()
+            self.local.identity = identity
+        return conn
+
+
+connection_pool = ConnectionPool(DATABASE_FILENAME, DATABASE_IMMUTABLE)
+
+
+TableSchema = collections.namedtuple("TableSchema", "name columns column_types row_count indexes internal")
+
+def quote_identifier(name):
+    return "\"%s\"" % name.replace("\"", "\"\"")
+
+def load_schema(conn):
+    """
+        Read the tables in the database, returning a dictionary mapping each
+        table name to a TableSchema, with its column names and declared
+        types, row count and indexes as (index name, column names) tuples.
+        Internal tables are marked as such, and left out of the table lists.
+    """
+    c = conn.cursor()
+    c.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+    tables = c.fetchall()
+    data_names = set(data_table_names(tables))
+    schema = {}
+    for (table_name, sql) in tables:
+        quoted_table_name = quote_identifier(table_name)
+        c.execute("PRAGMA table_info(%s)" % quoted_table_name)
+        column_info = c.fetchall()
+        c.execute("SELECT count(*) FROM %s" % quoted_table_name)
+        row_count = c.fetchone()[0]
+        indexes = []
+        c.execute("PRAGMA index_list(%s)" % quoted_table_name)
+        for index_name in [ row[1] for row in c.fetchall() ]:
+            c.execute("PRAGMA index_info(%s)" % quote_identifier(index_name))
+            indexes.append((index_name, tuple(row[2] for row in sorted(c.fetchall()))))
+        schema[table_name] = TableSchema(table_name, tuple(row[1] for row in column_info),
+            tuple(row[2] for row in column_info), row_count, tuple(indexes), table_name not in data_names)
+    return schema
+
+
+class SchemaCatalog(object):
+    """
+        The schema of the database, read once and then only again when the
+        database file is replaced.  Handlers check table and column names
+        against it, rather than querying sqlite_master on every request.
+    """
+
+    def __init__(self):
+        self.identity = None
+        self.schema = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        identity = connection_pool.file_identity()
+        with self.lock:
+            if identity != self.identity:
+                self.schema = load_schema(connection_pool.get())
+                self.identity = identity
+            return self.schema
+
+
+schema_catalog = SchemaCatalog()
+
+
+class ResponseCache(object):
+    """
+        Keeps the most recently used rendered pages, up to max_size bytes of
+        them.  The pages only change when run-parse-html.py replaces the
+        database, and once that is noticed the cache is emptied.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.identity = None
+        self.lock = threading.Lock()
+
+    def get(self, key, identity):
+        with self.lock:
+            if identity != self.identity:
+                self.entries.clear()
+                self.size = 0
+                self.identity = identity
+                return None
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                # Move it to the most recently used end.
+                self.entries[key] = entry
+            return entry
+
+    def put(self, key, identity, entry):
+        content_type, body = entry
+        if len(body) > self.max_size:
+            return
+        with self.lock:
+            # A page rendered from a database that has since been replaced is not kept.
+            if identity != self.identity:
+                return
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= len(old_entry[1])
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_size:
+                old_key, old_entry = self.entries.popitem(last=False)
+                self.size -= len(old_entry[1])
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [ 0 ] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def write(self, lines, name, labels):
+        cumulative = 0
+        for (bound, count) in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %.6f' % (name, labels, self.total))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+
+
+class PageMetrics(object):
+    def __init__(self):
+        self.statuses = collections.defaultdict(int)
+        self.latency = Histogram()
+        self.sql_latency = Histogram()
+        self.render_latency = Histogram()
+        self.response_bytes = 0
+        self.cache_results = collections.defaultdict(int)
+
+
+class Metrics(object):
+    """
+        Counts the requests for each page, with the time they took and the
+        bytes sent.  Requests for paths which are not pages are counted
+        together, so that they cannot add an entry each.
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def record(self, path, status, total_time, sql_time, response_bytes, cache_result):
+        if path not in RequestHandler.page_handlers and path not in RequestHandler.pages:
+            path = "unknown"
+        with self.lock:
+            page = self.pages.get(path)
+            if page is None:
+                page = self.pages[path] = PageMetrics()
+            page.statuses[status] += 1
+            page.latency.observe(total_time)
+            page.sql_latency.observe(sql_time)
+            page.render_latency.observe(max(0.0, total_time - sql_time))
+            page.response_bytes += response_bytes
+            if cache_result is not None:
+                page.cache_results[cache_result] += 1
+
+    def record_rejected(self):
+        with self.lock:
+            self.rejected += 1
+
+    def render(self):
+        with self.lock:
+            pages = sorted(self.pages.items())
+            lines = [
+                "# HELP pysrd_requests_total Requests served, by page and status.",
+                "# TYPE pysrd_requests_total counter",
+            ]
+            for (path, page) in pages:
+                for (status, count) in sorted(page.statuses.items()):
+                    lines.append('pysrd_requests_total{page="%s",status="%d"} %d' % (path, status, count))
+            for (name, attribute, description) in [
+                    ("pysrd_request_seconds", "latency", "Time taken to serve requests."),
+                    ("pysrd_request_sql_seconds", "sql_latency", "Time requests spent in SQLite."),
+                    ("pysrd_request_render_seconds", "render_latency", "Time requests spent rendering and sending pages."),
+                    ]:
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s histogram" % name)
+                for (path, page) in pages:
+                    getattr(page, attribute).write(lines, name, 'page="%s"' % path)
+            lines.append("# HELP pysrd_response_bytes_total Bytes of response bodies sent.")
+            lines.append("# TYPE pysrd_response_bytes_total counter")
+            for (path, page) in pages:
+                lines.append('pysrd_response_bytes_total{page="%s"} %d' % (path, page.response_bytes))
+            lines.append("# HELP pysrd_cache_requests_total Response cache results, as hit, miss or not_modified.")
+            lines.append("# TYPE pysrd_cache_requests_total counter")
+            for (path, page) in pages:
+                for (cache_result, count) in sorted(page.cache_results.items()):
+                    lines.append('pysrd_cache_requests_total{page="%s",result="%s"} %d' % (path, cache_result, count))
+            lines.append("# HELP pysrd_rejected_connections_total Connections turned away while the queue was full.")
+            lines.append("# TYPE pysrd_rejected_connections_total counter")
+            lines.append("pysrd_rejected_connections_total %d" % self.rejected)
+        with response_cache.lock:
+            cache_size, cache_entries = response_cache.size, len(response_cache.entries)
+        lines.append("# HELP pysrd_response_cache_bytes Bytes of rendered pages in the response cache.")
+        lines.append("# TYPE pysrd_response_cache_bytes gauge")
+        lines.append("pysrd_response_cache_bytes %d" % cache_size)
+        lines.append("# HELP pysrd_response_cache_entries Rendered pages in the response cache.")
+        lines.append("# TYPE pysrd_response_cache_entries gauge")
+        lines.append("pysrd_response_cache_entries %d" % cache_entries)
+        return "\n".join(lines) +"\n"
+
+
+metrics = Metrics()
+
+
+class AccessLog(object):
+    """Writes a line of JSON for each request, when a file has been opened."""
+
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
+
+    def open(self, file_name):
+        if file_name == "-":
+            self.file = sys.stdout
+        else:
+            self.file = open(file_name, "a")
+
+    def write(self, entry):
+        line = json.dumps(entry, sort_keys=True) +"\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+access_log = AccessLog()
+
+
+#####
+# Request bodies.
+
+class BodyError(Exception):
+    """A request body which cannot be accepted, with the status to respond with."""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class LengthDecoder(object):
+    """
+        A body of Content-Length bytes.  The decoders are told what a server
+        has read of the body, and tell it what to read next: wanted() is the
+        number of bytes, or None for a line.
+    """
+
+    def __init__(self, sink, length):
+        self.sink = sink
+        self.remaining = length
+        self.done = length == 0
+
+    def wanted(self):
+        return self.remaining
+
+    def data_received(self, data):
+        self.remaining -= len(data)
+        self.sink(data)
+        self.done = self.remaining == 0
+
+
+class ChunkedDecoder(object):
+    """
+        A chunked transfer encoded body.  The data of each chunk is passed on
+        as it is read, and any trailing headers are kept in trailers.
+    """
+
+    def __init__(self, sink, max_size):
+        self.sink = sink
+        self.max_size = max_size
+        self.size = 0
+        self.remaining = 0
+        self.state = "size"
+        self.trailer_lines = []
+        self.trailer_size = 0
+        self.trailers = None
+        self.done = False
+
+    def wanted(self):
+        if self.state == "data":
+            return self.remaining
+        return None
+
+    def data_received(self, data):
+        self.remaining -= len(data)
+        self.sink(data)
+        if self.remaining == 0:
+            self.state = "data_end"
+
+    def line_received(self, line):
+        if self.state == "size":
+            # HEX-LENGTH[;x=y], where the extensions are ignored.
+            try:
+                chunk_size = int(line.split(";")[0].strip(), 16)
+            except ValueError:
+                raise BodyError(400, "bad chunk size")
+            if chunk_size < 0:
+                raise BodyError(400, "bad chunk size")
+            if chunk_size == 0:
+                self.state = "trailer"
+                return
+            self.size += chunk_size
+            if self.size > self.max_size:
+                raise BodyError(413, "request body larger than %d bytes" % self.max_size)
+            self.remaining = chunk_size
+            self.state = "data"
+        elif self.state == "data_end":
+            if line:
+                raise BodyError(400, "chunk data longer than its size")
+            self.state = "size"
+        elif self.state == "trailer":
+            if line:
+                self.trailer_size += len(line)
+                if self.trailer_size > MAX_PART_HEADER_SIZE:
+                    raise BodyError(400, "chunk trailer too large")
+                self.trailer_lines.append(line)
+                return
+            self.trailers = mimetools.Message(cStringIO.StringIO("\r\n".join(self.trailer_lines + [ "", "" ])))
+            self.done = True
+
+
+class UploadedFile(object):
+    """
+        A file sent as part of a multipart/form-data body.  Page handlers are
+        given it in place of a value, and read it as a file.
+    """
+
+    def __init__(self, headers, name, filename):
+        self.headers = headers
+        self.name = name
+        self.filename = filename
+        self.content_type = headers.get("content-type", "application/octet-stream")
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def __iter__(self):
+        return iter(self.file.readline, "")
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class MultipartParser(object):
+    """
+        Parses a multipart/form-data body as it is read, holding no more than
+        a read's worth of it in memory.  Each part is written to an
+        UploadedFile as it arrives, and a part without a file name is a form
+        field, which is limited to MAX_FORM_SIZE bytes.
+    """
+
+    max_size = None
+
+    def __init__(self, boundary):
+        if not boundary or len(boundary) > 70:
+            raise BodyError(400, "bad multipart boundary")
+        # The first delimiter has no line break before it, so one is supplied.
+        self.delimiter = "\r\n--"+ boundary
+        self.buffer = "\r\n"
+        self.state = "preamble"
+        self.part = None
+        self.parts = []
+
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.state in ("preamble", "data"):
+                index = self.buffer.find(self.delimiter)
+                if index == -1:
+                    # What could be the start of a delimiter is kept, and the rest written.
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        self.write(self.buffer[:-keep])
+                        self.buffer = self.buffer[-keep:]
+                    return
+                self.write(self.buffer[:index])
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                if self.part is not None:
+                    self.part.seek(0)
+                    self.part = None
+                self.state = "delimiter"
+            elif self.state == "delimiter":
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer.startswith("--"):
+                    self.state = "epilogue"
+                    continue
+                # The delimiter line can be padded with white space.
+                index = self.buffer.find("\r\n")
+                if index == -1:
+                    if len(self.buffer) > MAX_LINE_SIZE:
+                        raise BodyError(400, "bad multipart delimiter")
+                    return
+                if self.buffer[:index].strip(" \t"):
+                    raise BodyError(400, "bad multipart delimiter")
+                self.buffer = self.buffer[index + 2:]
+                self.state = "headers"
+            elif self.state == "headers":
+                if self.buffer.startswith("\r\n"):
+                    header_data, self.buffer = "", self.buffer[2:]
+                else:
+                    index = self.buffer.find("\r\n\r\n")
+                    if index == -1:
+                        if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                            raise BodyError(400, "multipart part headers too large")
+                        return
+                    header_data, self.buffer = self.buffer[:index + 2], self.buffer[index + 4:]
+                self.start_part(mimetools.Message(cStringIO.StringIO(header_data +"\r\n")))
+                self.state = "data"
+            else:
+                # The epilogue after the last part is ignored.
+                self.buffer = ""
+                return
+
+    def start_part(self, headers):
+        if len(self.parts) >= MAX_PARTS:
+            raise BodyError(413, "more than %d parts in multipart body" % MAX_PARTS)
+        disposition, parameters = cgi.parse_header(headers.get("content-disposition", ""))
+        if disposition != "form-data" or "name" not in parameters:
+            raise BodyError(400, "multipart part without a form-data name")
+        self.part = UploadedFile(headers, parameters["name"], parameters.get("filename"))
+        self.parts.append(self.part)
+
+    def write(self, data):
+        # Anything before the first delimiter is ignored.
+        if self.part is None or not data:
+            return
+        if self.part.filename is None and self.part.size + len(data) > MAX_FORM_SIZE:
+            raise BodyError(413, "form field larger than %d bytes" % MAX_FORM_SIZE)
+        self.part.write(data)
+
+    def finish(self):
+        """The form, mapping each name to a list of values and files."""
+        if self.state != "epilogue":
+            raise BodyError(400, "multipart body ended before its last part")
+        form = {}
+        for part in self.parts:
+            if part.filename is None:
+                value = part.read()
+                part.close()
+            else:
+                value = part
+            form.setdefault(part.name, []).append(value)
+        return form
+
+    def close(self):
+        for part in self.parts:
+            part.close()
+
+
+class FormBody(object):
+    """An application/x-www-form-urlencoded body, which is kept in memory."""
+
+    max_size = MAX_FORM_SIZE
+
+    def __init__(self):
+        self.data = []
+
+    def feed(self, data):
+        self.data.append(data)
+
+    def finish(self):
+        return cgi.parse_qs("".join(self.data), keep_blank_values=1)
+
+    def close(self):
+        self.data = []
 
-table_display_columns = {
-    "abilities":            [ "id", "name", "shortname" ],
-    "class":                [ "id", "name", "type" ],
-    "class_table":          [ "id", "name", "level" ],
-    "conditions":           [ "id", "name" ],
-    "domain":               [ "id", "name" ],
-    "equipment":            [ "id", "name", "family", "category", "subcategory" ],
-    "feat":                 [ "id", "name", "type" ],
-    "item":                 [ "id", "name", "category", "subcategory" ],
-    "monster":              [ "id", "family", "name", "altname", "size", "type", "descriptor", "environment" ],
-    "power":                [ "id", "name", "discipline", "subdiscipline", "descriptor" ],
-    "skill":                [ "id", "name", "subtype" ],
-    "special_abilities":    [ "id", "name" ],
-    "spell":                [ "id", "name", "school", "subschool", "descriptor" ],
-}
-
-table_sort_column = {
-    "class": "name",
-}
+
+class DiscardedBody(object):
+    """A body of a type no page takes, which is read and thrown away."""
+
+    max_size = None
+
+    def feed(self, data):
+        pass
+
+    def finish(self):
+        return None
+
+    def close(self):
+        pass
+
+
+def body_consumer(headers):
+    """What the body of a request is passed to, by its content type."""
+    content_type, parameters = cgi.parse_header(headers.get("content-type", ""))
+    if content_type == "multipart/form-data":
+        return MultipartParser(parameters.get("boundary"))
+    if content_type == "application/x-www-form-urlencoded":
+        return FormBody()
+    return DiscardedBody()
+
+def body_decoder(headers, consumer, max_size):
+    """The decoder passing the body of a request to the consumer, or None when it has no body."""
+    if consumer.max_size is not None:
+        max_size = min(max_size, consumer.max_size)
+    transfer_encoding = headers.get("transfer-encoding", "").strip().lower()
+    if transfer_encoding == "chunked":
+        return ChunkedDecoder(consumer.feed, max_size)
+    if transfer_encoding not in ("", "identity"):
+        raise BodyError(501, "unsupported transfer encoding")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise BodyError(400, "bad content length")
+    if length < 0:
+        raise BodyError(400, "bad content length")
+    if length > max_size:
+        raise BodyError(413, "request body larger than %d bytes" % max_size)
+    if length == 0:
+        return None
+    return LengthDecoder(consumer.feed, length)
+
+def read_body(rfile, decoder):
+    """Read a body from a blocking file, a line or up to READ_SIZE bytes at a time."""
+    while not decoder.done:
+        wanted = decoder.wanted()
+        if wanted is None:
+            line = rfile.readline(MAX_LINE_SIZE + 1)
+            if not line.endswith("\n"):
+                raise BodyError(400, "request body ended early" if not line else "chunk line too long")
+            decoder.line_received(line.rstrip("\r\n"))
+        else:
+            data = rfile.read(min(wanted, READ_SIZE))
+            if not data:
+                raise BodyError(400, "request body ended early")
+            decoder.data_received(data)
+
+def close_form(form):
+    if form is None:
+        return
+    for values in form.itervalues():
+        for value in values:
+            if isinstance(value, UploadedFile):
+                value.close()
+
+
+def record_request(client, path, query, status, start_time, response_bytes, encoding):
+    """Record a request the calling thread has finished serving."""
+    total_time = timer() - start_time
+    metrics.record(path, status, total_time, request_timer.sql_time, response_bytes, request_timer.cache_result)
+    if access_log.file is not None:
+        access_log.write({
+            "time": round(time.time() - total_time, 3),
+            "client": client,
+            "path": path,
+            "query": query,
+            "status": status,
+            "bytes": response_bytes,
+            "seconds": round(total_time, 6),
+            "sql_seconds": round(request_timer.sql_time, 6),
+            "cache": request_timer.cache_result,
+            "encoding": encoding,
+        })
 
 
 class RequestHandler(BaseHTTPRequestHandler):
     # Respect keep alive requests.
     protocol_version = "HTTP/1.1"
-    useChunked = False
+    # Idle keep alive connections are closed, freeing their worker.
+    timeout = KEEP_ALIVE_TIMEOUT
+    # The headers are written a line at a time, and the last should not wait on the client acknowledging the first.
+    disable_nagle_algorithm = True
 
     page_handlers = {}
+    # Pages which are not html.
+    page_content_types = {}
+    # Pages which are rendered for every request.
+    uncached_pages = set()
     pages = {}
 
     def __init__(self, *args, **kwargs):
@@ -73,158 +915,110 @@ class RequestHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         scheme, netloc, path, parameters, query, fragment = urlparse.urlparse(self.path, "http")
-        self.handle_command(path, query, "")
+        request_timer.reset()
+        self.handle_command(path, query, None, timer())
 
     def do_POST(self):
         scheme, netloc, path, parameters, query, fragment = urlparse.urlparse(self.path, "http")
-        contentType, contentTypeParameters = cgi.parse_header(self.headers.getheader('content-type'))
-        contentLength = int(self.headers.get("content-length", -1))
-
-        content = ""
-        kwargs = None
-        if contentType == "multipart/form-data":
-            content, multiparts = self.ExtractMultiparts(contentTypeParameters, contentLength)
-        elif contentType == "application/x-www-form-urlencoded":
-            query = self.rfile.read(contentLength)
-
-        self.handle_command(path, query, content)
-
-    def handle_command(self, path, query, content):
-        kwargs = cgi.parse_qs(query, keep_blank_values=1)
-        transferEncoding = self.headers.get("transfer-encoding")
-        
-        if transferEncoding == "chunked":
-            # As I understand it the additional headers should be incorporated into
-            # self.headers and "chunked" cleared from the transfer-encoding header.
-            additionalHeaders, content = self.ReadChunks()
-
-        # path == "/mud-push"
-        body = None
-        print "\"%s\"" % path
-        if path in self.page_handlers:
-            body = self.page_handlers[path](self, path, kwargs)
-        elif path in self.pages:
-            body = open(pages[path], "r").read()
-
-        if body is not None:
-            insert = ""
-            for k, v in self.headers.items():
-                insert += "%s: %s<br>" % (k, v)
-            # insert += str((scheme, netloc, path, parameters, query, fragment)) +"<br>"
-
-            body = body.replace("--BODY--", insert)
-
+        request_timer.reset()
+        start_time = timer()
+
+        consumer = None
+        try:
+            consumer = body_consumer(self.headers)
+            decoder = body_decoder(self.headers, consumer, self.server.max_body_size)
+            if decoder is not None:
+                if self.headers.get("expect", "").lower() == "100-continue" and self.request_version == "HTTP/1.1":
+                    self.wfile.write("HTTP/1.1 100 Continue\r\n\r\n")
+                read_body(self.rfile, decoder)
+                if isinstance(decoder, ChunkedDecoder):
+                    # The trailing headers are taken as if they had been sent before the body.
+                    for name in decoder.trailers.keys():
+                        self.headers[name] = decoder.trailers[name]
+                    del self.headers["transfer-encoding"]
+            form = consumer.finish()
+        except BodyError, e:
+            if consumer is not None:
+                consumer.close()
+            self.send_error(e.status, str(e))
+            record_request(self.client_address[0], path, query, e.status, start_time, 0, None)
+            return
+
+        try:
+            self.handle_command(path, query, form, start_time)
+        finally:
+            close_form(form)
+
+    def handle_command(self, path, query, form, start_time):
+        """Send the page for a request, recording the time since start_time that it took."""
+        try:
+            status, content_type, body, etag, encoding = dispatch(self, path, query, self.headers, form)
+        except Exception:
+            traceback.print_exc()
+            status, content_type, body, etag, encoding = 500, "text/plain", "500 - Internal Server Error.", None, None
+        response_bytes = 0
+
+        if status == 304:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+        elif status == 200:
             self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            if self.useChunked:
-                self.send_header("Transfer-Encoding", "chunked")
-            else:
+            self.send_header("Content-type", content_type)
+            if etag is not None:
+                self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            if isinstance(body, str):
                 self.send_header("Content-Length", len(body))
-            self.end_headers()
-
-            if self.useChunked:
-                halfLen = int(len(body) / 2)
-                chunk1 = body[:halfLen]
-                chunk2 = body[halfLen:]
-
-                self.WriteChunk(chunk1)
-                self.WriteChunk(chunk2)
-                self.WriteChunk()
-            elif path.endswith(".ico") != ".":     # EXPLICIT BINARY FILES
+                self.end_headers()
                 self.wfile.write(body)
-            else:                                   # TEXT
-                self.wfile.write(body.encode('ascii','xmlcharrefreplace'))
+                response_bytes = len(body)
+            else:
+                # The page is sent as it is rendered.  HTTP/1.0 clients do not
+                # understand chunks, and are sent it up to the connection closing.
+                useChunked = self.request_version == "HTTP/1.1"
+                if useChunked:
+                    self.send_header("Transfer-Encoding", "chunked")
+                else:
+                    self.send_header("Connection", "close")
+                    self.close_connection = 1
+                self.end_headers()
+
+                try:
+                    for chunk in body:
+                        if useChunked:
+                            self.WriteChunk(chunk)
+                        else:
+                            self.wfile.write(chunk)
+                        response_bytes += len(chunk)
+                except socket.error:
+                    raise
+                except Exception:
+                    # The headers have been sent, so all that can be done is to cut the page short.
+                    traceback.print_exc()
+                    status = 500
+                    self.close_connection = 1
+                else:
+                    if useChunked:
+                        self.WriteChunk()
         else:
-            # Page not found.
-            self.send_response(404,"Page not found")
-            body = "404 - Page '%s' not found." % path
-            self.send_header("Content-type", "text/plain")
+            # Page not found, or the page handler failed.
+            self.send_response(status)
+            self.send_header("Content-type", content_type)
             self.send_header("Content-Length", len(body))
             self.end_headers()
 
             self.wfile.write(body)
+            response_bytes = len(body)
+
+        record_request(self.client_address[0], path, query, status, start_time, response_bytes, encoding)
 
-    def ExtractMultiparts(self, contentTypeParameters, contentLength):
-        initialPartBoundary = "--"+ contentTypeParameters["boundary"] +"\r\n"
-        interimPartBoundary = "\r\n"+ initialPartBoundary
-        finalPartBoundary = "\r\n--"+ contentTypeParameters["boundary"] +"--\r\n"
-        partBoundary = initialPartBoundary
-
-        content = ""
-        contentRead = 0
-        multiparts = []
-
-        rawData = ""
-        rawDataOffset = 0
-
-        # We assume that there may be leading data before the first boundary.
-        lastDataStart = 0
-        while contentRead < contentLength:
-            readSize = min(contentLength - contentRead, 98304)
-            rawData += self.rfile.read(readSize)
-            contentRead += readSize
-
-            while 1:
-                # Do we have another part header in the read data?
-                headerOffset = rawData.find(partBoundary, rawDataOffset)
-                if headerOffset == -1:
-                    break # Read more data.
-
-                if headerOffset > lastDataStart:
-                    if lastDataStart == 0:
-                        content = rawData[lastDataStart:headerOffset]
-                    else:
-                        multiparts[-1][1] = rawData[lastDataStart:headerOffset]
-
-                headerOffset += len(partBoundary)
-                partBoundary = interimPartBoundary
-
-                # Do we have the end of the part header in the read data?
-                dataOffset = rawData.find("\r\n\r\n", headerOffset)
-                if dataOffset == -1:
-                    break # Read more data.
-
-                # Skip past the header end to the start of the data.
-                dataOffset += 4
-                lastDataStart = dataOffset
-
-                # Extract the headers into a file-like object.
-                sio = cStringIO.StringIO()
-                sio.write(rawData[headerOffset:dataOffset])
-                sio.seek(0)
-
-                multiparts.append([ self.MessageClass(sio), None ])
-
-                rawDataOffset = headerOffset
-
-        # Extract the last bit of data.
-        headerOffset = rawData.find(finalPartBoundary, lastDataStart)
-        if headerOffset != -1:
-            multiparts[-1][1] = rawData[lastDataStart:headerOffset]
-
-        return content, multiparts
-
-    def ReadChunks(self):
-        # Possible improvement: Work out what to do with these extensions.
-
-        def ReadChunkHeader():
-            # HEX-LENGTH[;x=y]\r\n
-            line = self.rfile.readline()
-            bits = [ bit.strip() for bit in line.split(";") ]
-            extension = None
-            if len(bits) == 2:
-                extension = bits[1].split("=")
-            return int(bits[1], 16), extension
-
-        data = cStringIO.StringIO()
-        chunkSize, extension = ReadChunkHeader()
-        while chunkSize > 0:
-            data.write(self.rfile.read(chunkSize))
-            self.rfile.read(2)
-            chunkSize, extension = ReadChunkHeader()
-        # Optional chunk trailer after the last one.
-        headers = self.MessageClass(self.rfile, 0)
-        return headers, data.getvalue()
+    def log_request(self, code="-", size="-"):
+        # Requests are counted in the metrics, and written to the access log if there is one.
+        pass
 
     def WriteChunk(self, data=None, **kwargs):
         """
@@ -232,38 +1026,657 @@ class RequestHandler(BaseHTTPRequestHandler):
             Requires that a chunked Transfer-Encoding header was set.
             If used, chunks should be finalised with a final one with no data.
         """
-        data = data.encode('ascii','xmlcharrefreplace')
+        if isinstance(data, unicode):
+            data = data.encode('ascii','xmlcharrefreplace')
 
         xtra = ""
         for k, v in kwargs.iteritems():
-            xtra += ";%s=%s"
+            xtra += ";%s=%s" % (k, v)
         chunkSize = data and len(data) or 0
         self.wfile.write("%X%s\r\n" % (chunkSize, xtra))
         if data:
             self.wfile.write(data)
         self.wfile.write("\r\n")
 
-def run():
-    address = ('127.0.0.1', 9000)
-    print "Starting web server on %s port %d" % address
-    server = StacklessHTTPServer(address, RequestHandler)
-    server.serve_forever()
-
-
-#class HTTPServer(ThreadingMixIn, HTTPServer):
-#    pass
-
-
-def table_link(table_name, sort_column_name=None, link_text=None):
+def normalize_query(query):
+    # Only the names are sorted, as the order of repeated values matters.
+    return urllib.urlencode(sorted(cgi.parse_qsl(query, keep_blank_values=1), key=lambda pair: pair[0]))
+
+def make_etag(identity, encoding):
+    # Each compression of a page is a different representation, with its own tag.
+    tag = hashlib.sha1(repr(identity)).hexdigest()[:20]
+    if encoding is not None:
+        tag += "-"+ encoding
+    return "\"%s\"" % tag
+
+def etag_matches(etag, headers):
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == "*" or etag in [ tag.strip() for tag in if_none_match.split(",") ]
+
+def accepted_encoding(headers):
+    """The compression the client most prefers of those available, or None."""
+    qualities = {}
+    for part in headers.get("accept-encoding", "").split(","):
+        bits = part.split(";")
+        quality = 1.0
+        for parameter in bits[1:]:
+            name, sep, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[bits[0].strip().lower()] = quality
+    for encoding in COMPRESS_ENCODINGS:
+        if qualities.get(encoding, qualities.get("*", 0.0)) > 0.0:
+            return encoding
+    return None
+
+def compressor(encoding):
+    # gzip has a header and trailer around the deflate data, and "deflate" means zlib's format.
+    if encoding == "gzip":
+        return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS)
+
+def compress_chunks(chunks, encoding):
+    # Each chunk is flushed, so the client can show the page as it arrives.
+    compressobj = compressor(encoding)
+    for chunk in chunks:
+        data = compressobj.compress(chunk) + compressobj.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressobj.flush()
+
+def encode_chunks(fragments):
+    """
+        Encode the fragments a page handler yields, joining them into chunks
+        of at least CHUNK_SIZE bytes.
+    """
+    chunk = []
+    chunk_size = 0
+    for fragment in fragments:
+        if isinstance(fragment, unicode):
+            fragment = fragment.encode('ascii','xmlcharrefreplace')
+        chunk.append(fragment)
+        chunk_size += len(fragment)
+        if chunk_size >= CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield "".join(chunk)
+
+def cache_chunks(key, identity, content_type, chunks):
+    # The page is kept as it is sent, unless it turns out too large to cache.
+    kept_chunks = []
+    kept_size = 0
+    for chunk in chunks:
+        if kept_chunks is not None:
+            kept_size += len(chunk)
+            if kept_size > response_cache.max_size:
+                kept_chunks = None
+            else:
+                kept_chunks.append(chunk)
+        yield chunk
+    if kept_chunks is not None:
+        response_cache.put(key, identity, (content_type, "".join(kept_chunks)))
+
+def render_page(handler, path, kwargs):
+    if path in RequestHandler.page_handlers:
+        return RequestHandler.page_handlers[path](handler, path, kwargs)
+    return open(RequestHandler.pages[path], "r").read()
+
+def dispatch(handler, path, query, headers, form=None):
+    """
+        Render the page for a request, returning (status, content type, body,
+        ETag, content encoding) with the body encoded ready to send.  Page
+        handlers can return the whole page, or be generators yielding it in
+        parts, in which case the body is an iterator of chunks.  Both the
+        threaded and the asynchronous servers serve pages through this.
+        The form of a POST request is added to the arguments of the query.
+    """
+    if path not in RequestHandler.page_handlers and path not in RequestHandler.pages:
+        return 404, "text/plain", "404 - Page '%s' not found." % path, None, None
+
+    content_type = RequestHandler.page_content_types.get(path, "text/html")
+
+    # Pages rendered from a form are not cached, as the form is not part of the key.
+    if form is not None or path in RequestHandler.uncached_pages:
+        kwargs = cgi.parse_qs(query, keep_blank_values=1)
+        for name, values in (form or {}).iteritems():
+            kwargs.setdefault(name, []).extend(values)
+        body = render_page(handler, path, kwargs)
+        if isinstance(body, unicode):
+            body = body.encode('ascii','xmlcharrefreplace')
+        elif not isinstance(body, str):
+            body = encode_chunks(body)
+        return 200, content_type, body, None, None
+
+    # The pages only change when the database file is replaced.
+    identity = connection_pool.file_identity()
+    encoding = accepted_encoding(headers)
+    for etag_encoding in set([ None, encoding ]):
+        etag = make_etag(identity, etag_encoding)
+        if etag_matches(etag, headers):
+            request_timer.cache_result = "not_modified"
+            return 304, content_type, "", etag, etag_encoding
+
+    # The compressed pages are cached alongside the uncompressed ones.
+    key = path, normalize_query(query)
+    if encoding is not None:
+        entry = response_cache.get(key + (encoding,), identity)
+        if entry is not None:
+            request_timer.cache_result = "hit"
+            return (200,) + entry + (make_etag(identity, encoding), encoding)
+    entry = response_cache.get(key + (None,), identity)
+
+    request_timer.cache_result = "hit" if entry is not None else "miss"
+    if entry is None:
+        body = render_page(handler, path, cgi.parse_qs(query, keep_blank_values=1))
+
+        if not isinstance(body, types.StringTypes):
+            # The size of a page being streamed is not known, so it is compressed regardless.
+            chunks = cache_chunks(key + (None,), identity, content_type, encode_chunks(body))
+            if encoding is not None:
+                chunks = cache_chunks(key + (encoding,), identity, content_type, compress_chunks(chunks, encoding))
+            return 200, content_type, chunks, make_etag(identity, encoding), encoding
+
+        if "--BODY--" in body:
+            # A page showing the headers of the request differs for each one, so is neither cached nor tagged.
+            request_timer.cache_result = None
+            insert = ""
+            for k, v in headers.items():
+                insert += "%s: %s<br>" % (k, v)
+            body = body.replace("--BODY--", insert)
+            if isinstance(body, unicode):
+                body = body.encode('ascii','xmlcharrefreplace')
+            return 200, content_type, body, None, None
+
+        if isinstance(body, unicode):
+            body = body.encode('ascii','xmlcharrefreplace')
+        entry = content_type, body
+        response_cache.put(key + (None,), identity, entry)
+
+    content_type, body = entry
+    if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+        return 200, content_type, body, make_etag(identity, None), None
+    compressobj = compressor(encoding)
+    body = compressobj.compress(body) + compressobj.flush()
+    response_cache.put(key + (encoding,), identity, (content_type, body))
+    return 200, content_type, body, make_etag(identity, encoding), encoding
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+        Hands accepted connections to a fixed set of worker threads through
+        a bounded queue.  While the queue is full, accepting stops, and a
+        connection which cannot be queued within QUEUE_TIMEOUT is sent a 503
+        response and closed.
+    """
+
+    # Let the listen backlog hold connections while the queue is full.
+    request_queue_size = 64
+
+    def __init__(self, address, handler_class, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+            max_body_size=MAX_BODY_SIZE):
+        self.max_body_size = max_body_size
+        HTTPServer.__init__(self, address, handler_class)
+        self.requests = Queue.Queue(queue_size)
+        self.workers = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.process_request_thread, name="worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put((request, client_address), True, QUEUE_TIMEOUT)
+        except Queue.Full:
+            metrics.record_rejected()
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        try:
+            request.sendall("HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n"
+                "Content-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n")
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self):
+        while True:
+            request, client_address = self.requests.get()
+            if request is None:
+                break
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        # Workers finish the connections already queued before stopping.
+        for thread in self.workers:
+            self.requests.put((None, None))
+        for thread in self.workers:
+            thread.join()
+
+
+#####
+# Asynchronous server.
+
+def socket_pair():
+    # socket.socketpair is not available on Windows.
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, address = listener.accept()
+    listener.close()
+    return server, client
+
+
+class Waker(asyncore.dispatcher):
+    """Lets other threads wake the event loop, which then calls the callback."""
+
+    def __init__(self, socket_map, callback):
+        read_socket, self.write_socket = socket_pair()
+        self.write_socket.setblocking(0)
+        asyncore.dispatcher.__init__(self, read_socket, map=socket_map)
+        self.callback = callback
+
+    def wake(self):
+        try:
+            self.write_socket.send("x")
+        except socket.error:
+            # A full buffer means the loop already has a wake up pending.
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.callback()
+
+    def handle_close(self):
+        self.close()
+        self.write_socket.close()
+
+
+class AsyncHTTPChannel(asynchat.async_chat):
+    """
+        A client connection.  Requests are read and parsed in the event loop,
+        and their pages are rendered by the server's worker threads, one
+        request at a time for each connection.  Pipelined requests wait their
+        turn in pending.
+    """
+
+    max_header_size = 65536
+    max_pending = 16
+
+    def __init__(self, server, sock, client_address):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.client_address = client_address
+        self.set_terminator("\r\n\r\n")
+        self.incoming = []
+        self.incoming_size = 0
+        # A request whose body is still being read, and what it is read with.
+        self.body_request = None
+        self.body_consumer = None
+        self.body_decoder = None
+        self.pending = collections.deque()
+        # Identifies the request being rendered, so that a late result is ignored.
+        self.request_id = 0
+        self.busy_since = None
+        # Set while a page is being sent as it is rendered.
+        self.streaming = False
+        self.use_chunked = False
+        self.stream_keep_alive = False
+        self.keep_alive = True
+        self.last_activity = time.time()
+
+    def readable(self):
+        return self.keep_alive and len(self.pending) < self.max_pending and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        if self.body_decoder is not None and self.body_decoder.wanted() is not None:
+            # Body data is passed on as it arrives, rather than gathered.
+            try:
+                self.body_decoder.data_received(data)
+            except BodyError, e:
+                self.body_failed(e)
+            return
+        self.incoming.append(data)
+        self.incoming_size += len(data)
+        if self.incoming_size > (self.max_header_size if self.body_decoder is None else MAX_LINE_SIZE):
+            self.respond_error(400)
+
+    def found_terminator(self):
+        data = "".join(self.incoming)
+        self.incoming = []
+        self.incoming_size = 0
+
+        if self.body_decoder is not None:
+            try:
+                # The terminator of the body data counts down to zero, and that of a line stays.
+                if self.get_terminator() == "\r\n":
+                    self.body_decoder.line_received(data)
+                if not self.body_decoder.done:
+                    return self.set_terminator(self.body_decoder.wanted() or "\r\n")
+                form = self.body_consumer.finish()
+            except BodyError, e:
+                return self.body_failed(e)
+            path, query, headers, version, keep_alive = self.body_request
+            self.body_request = self.body_consumer = self.body_decoder = None
+            self.set_terminator("\r\n\r\n")
+            self.queue_request(path, query, headers, version, keep_alive, form)
+            return
+
+        # Blank lines may precede a request.
+        lines = data.lstrip("\r\n").split("\r\n")
+        words = lines[0].split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            return self.respond_error(400)
+        method, url, version = words
+        headers = mimetools.Message(cStringIO.StringIO("\r\n".join(lines[1:]) +"\r\n\r\n"))
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+        scheme, netloc, path, parameters, query, fragment = urlparse.urlparse(url, "http")
+
+        if method == "GET":
+            self.queue_request(path, query, headers, version, keep_alive, None)
+        elif method == "POST":
+            try:
+                consumer = body_consumer(headers)
+                decoder = body_decoder(headers, consumer, self.server.max_body_size)
+            except BodyError, e:
+                return self.respond_error(e.status)
+            if decoder is None:
+                return self.queue_request(path, query, headers, version, keep_alive, consumer.finish())
+            self.body_request = path, query, headers, version, keep_alive
+            self.body_consumer = consumer
+            self.body_decoder = decoder
+            self.set_terminator(decoder.wanted() or "\r\n")
+            if headers.get("expect", "").lower() == "100-continue" and version == "HTTP/1.1":
+                self.push("HTTP/1.1 100 Continue\r\n\r\n")
+        else:
+            self.respond_error(501)
+
+    def body_failed(self, error):
+        self.body_consumer.close()
+        self.body_request = self.body_consumer = self.body_decoder = None
+        self.respond_error(error.status)
+
+    def queue_request(self, path, query, headers, version, keep_alive, form):
+        self.pending.append((path, query, headers, version, keep_alive, form))
+        self.process_next_request()
+
+    def process_next_request(self):
+        if self.busy_since is not None or not self.pending or not self.connected:
+            return
+        path, query, headers, version, keep_alive, form = self.pending.popleft()
+        self.request_id += 1
+        self.busy_since = time.time()
+        self.server.submit(self, self.request_id, path, query, headers, version, keep_alive, form)
+
+    def response_lines(self, status, content_type, etag, encoding, keep_alive):
+        lines = [
+            "HTTP/1.1 %d %s" % (status, BaseHTTPRequestHandler.responses[status][0]),
+            "Date: %s" % email.utils.formatdate(usegmt=True),
+        ]
+        if etag is not None:
+            lines.append("ETag: %s" % etag)
+            lines.append("Vary: Accept-Encoding")
+        if encoding is not None and status != 304:
+            lines.append("Content-Encoding: %s" % encoding)
+        # A 304 response never has a body.
+        if status != 304:
+            lines.append("Content-Type: %s" % content_type)
+        if not keep_alive:
+            lines.append("Connection: close")
+        return lines
+
+    def respond(self, status, content_type, body, etag, encoding, keep_alive):
+        keep_alive = keep_alive and self.server.running
+        lines = self.response_lines(status, content_type, etag, encoding, keep_alive)
+        if status != 304:
+            lines.append("Content-Length: %d" % len(body))
+        self.push("\r\n".join(lines) +"\r\n\r\n"+ body)
+        self.finish_response(keep_alive)
+
+    def respond_start(self, status, content_type, etag, encoding, version, keep_alive):
+        # HTTP/1.0 clients do not understand chunks, and are sent the page up to the connection closing.
+        self.use_chunked = version == "HTTP/1.1"
+        self.stream_keep_alive = keep_alive and self.server.running and self.use_chunked
+        self.streaming = True
+        lines = self.response_lines(status, content_type, etag, encoding, self.stream_keep_alive)
+        if self.use_chunked:
+            lines.append("Transfer-Encoding: chunked")
+        self.push("\r\n".join(lines) +"\r\n\r\n")
+        self.last_activity = self.busy_since = time.time()
+
+    def respond_chunk(self, data):
+        if self.use_chunked:
+            data = "%X\r\n%s\r\n" % (len(data), data)
+        self.push(data)
+        # A page still being rendered has not timed out.
+        self.last_activity = self.busy_since = time.time()
+
+    def respond_finish(self):
+        if self.use_chunked:
+            self.push("0\r\n\r\n")
+        self.finish_response(self.stream_keep_alive)
+
+    def respond_abort(self):
+        # The headers have been sent, so all that can be done is to cut the page short.
+        self.request_id += 1
+        self.finish_response(False)
+
+    def finish_response(self, keep_alive):
+        self.busy_since = None
+        self.streaming = False
+        self.last_activity = time.time()
+        if keep_alive:
+            self.process_next_request()
+        else:
+            self.keep_alive = False
+            self.pending.clear()
+            self.close_when_done()
+
+    def respond_error(self, status):
+        if self.streaming:
+            return self.respond_abort()
+        # Any request being rendered is abandoned, and its result ignored.
+        self.request_id += 1
+        message = BaseHTTPRequestHandler.responses[status][0]
+        self.respond(status, "text/plain", "%d - %s." % (status, message), None, None, False)
+
+    def handle_write(self):
+        asynchat.async_chat.handle_write(self)
+        self.last_activity = time.time()
+
+    def check_timeouts(self, now):
+        if self.busy_since is not None:
+            if now - self.busy_since > self.server.request_timeout:
+                self.respond_error(504)
+        elif self.producer_fifo:
+            # A slow client is still being sent a response, and is only given up on once it stops reading.
+            if now - self.last_activity > SEND_TIMEOUT:
+                self.close()
+        elif now - self.last_activity > KEEP_ALIVE_TIMEOUT:
+            self.close()
+
+    def handle_error(self):
+        self.server.handle_error()
+        self.close()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    """
+        Serves many mostly idle keep-alive connections from a single thread,
+        with each page rendered in a pool of worker threads so that database
+        work never blocks the event loop.  Rendering that takes longer than
+        the request timeout gets a 504 response, although the worker cannot
+        be interrupted and finishes it regardless.
+    """
+
+    def __init__(self, address, workers=DEFAULT_WORKERS, request_timeout=DEFAULT_REQUEST_TIMEOUT,
+            max_body_size=MAX_BODY_SIZE):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+
+        self.request_timeout = request_timeout
+        self.max_body_size = max_body_size
+        self.pool = ThreadPool(workers)
+        self.completed = Queue.Queue()
+        self.waker = Waker(self.socket_map, self.process_completed)
+        self.running = True
+
+    def handle_accept(self):
+        # Take every waiting connection, rather than one per pass of the loop.
+        for i in range(100):
+            pair = self.accept()
+            if pair is None:
+                break
+            sock, client_address = pair
+            AsyncHTTPChannel(self, sock, client_address)
+
+    def channels(self):
+        return [ channel for channel in self.socket_map.values() if isinstance(channel, AsyncHTTPChannel) ]
+
+    def submit(self, channel, request_id, path, query, headers, version, keep_alive, form):
+        self.pool.apply_async(self.render, (channel, request_id, path, query, headers, version, keep_alive, form))
+
+    def post(self, channel, request_id, method_name, args):
+        # Pool threads hand their results back to the event loop, which calls the channel method.
+        self.completed.put((channel, request_id, method_name, args))
+        self.waker.wake()
+
+    def render(self, channel, request_id, path, query, headers, version, keep_alive, form):
+        try:
+            self.render_page(channel, request_id, path, query, headers, version, keep_alive, form)
+        finally:
+            close_form(form)
+
+    def render_page(self, channel, request_id, path, query, headers, version, keep_alive, form):
+        """
+            Render a page in a pool thread, posting it to the channel whole or
+            in chunks.  The time recorded for it is that taken to render it,
+            as the event loop sends it.
+        """
+        request_timer.reset()
+        start_time = timer()
+        try:
+            status, content_type, body, etag, encoding = dispatch(None, path, query, headers, form)
+        except Exception:
+            traceback.print_exc()
+            status, content_type, body, etag, encoding = 500, "text/plain", "500 - Internal Server Error.", None, None
+
+        if isinstance(body, str):
+            self.post(channel, request_id, "respond", (status, content_type, body, etag, encoding, keep_alive))
+            return record_request(channel.client_address[0], path, query, status, start_time, len(body), encoding)
+
+        self.post(channel, request_id, "respond_start", (status, content_type, etag, encoding, version, keep_alive))
+        response_bytes = 0
+        try:
+            for chunk in body:
+                # Stop rendering a page that has been abandoned.
+                if channel.request_id != request_id:
+                    return
+                self.post(channel, request_id, "respond_chunk", (chunk,))
+                response_bytes += len(chunk)
+        except Exception:
+            traceback.print_exc()
+            self.post(channel, request_id, "respond_abort", ())
+            return record_request(channel.client_address[0], path, query, 500, start_time, response_bytes, encoding)
+        self.post(channel, request_id, "respond_finish", ())
+        record_request(channel.client_address[0], path, query, status, start_time, response_bytes, encoding)
+
+    def process_completed(self):
+        while True:
+            try:
+                channel, request_id, method_name, args = self.completed.get_nowait()
+            except Queue.Empty:
+                break
+            if channel.connected and channel.request_id == request_id:
+                getattr(channel, method_name)(*args)
+
+    def serve_forever(self):
+        # poll copes with more connections than select can.
+        use_poll = hasattr(select, "poll")
+        last_check_time = time.time()
+        try:
+            while self.running:
+                asyncore.loop(1.0, use_poll, self.socket_map, 1)
+                now = time.time()
+                if now - last_check_time >= 1.0:
+                    for channel in self.channels():
+                        channel.check_timeouts(now)
+                    last_check_time = now
+        except KeyboardInterrupt:
+            pass
+        self.shutdown(use_poll)
+
+    def stop(self, *args):
+        self.running = False
+
+    def shutdown(self, use_poll):
+        """
+            Stop accepting connections, close those that are idle, and let
+            those with a request in progress finish it before closing.
+        """
+        self.running = False
+        self.close()
+        deadline = time.time() + self.request_timeout
+        while time.time() < deadline:
+            channels = self.channels()
+            for channel in channels:
+                if channel.busy_since is None and not channel.producer_fifo:
+                    channel.close()
+            if not self.channels():
+                break
+            asyncore.loop(0.1, use_poll, self.socket_map, 1)
+        for channel in self.channels():
+            channel.close()
+        self.waker.handle_close()
+        self.pool.close()
+        self.pool.join()
+
+
+def table_link(table_name, sort_column_name=None, link_text=None, page=None, page_size=None):
     link = "/table?name=%s" % table_name
     if sort_column_name is not None:
         link += "&sort_column="+ sort_column_name
+    if page is not None:
+        link += "&page=%d" % page
+    if page_size is not None:
+        link += "&page_size=%d" % page_size
     if link_text is None:
         link_text = table_name
     return "<a href='%s'>%s</a>" % (link, link_text)
 
-def table_row_link(table_name, row_id):
-    return "<a href='/row?table=%s&row_id=%s'>%s</a>" % (table_name, row_id, row_id)
+def table_row_link(table_name, row_id, link_text=None):
+    if link_text is None:
+        link_text = row_id
+    return "<a href='/row?table=%s&row_id=%s'>%s</a>" % (table_name, row_id, link_text)
 
 
 def icon_fetcher(handler, path, kwargs):
@@ -281,21 +1694,14 @@ def page_view_row(handler, path, kwargs):
     except ValueError:
         return "invalid row id parameter in query string"
 
-    conn = sqlite3.connect(DATABASE_FILENAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM sqlite_master WHERE type='table'")
-
-    column_names = [ column_info[0] for column_info in c.description ]
-    idx = column_names.index("tbl_name")
-    table_names = [ row[idx] for row in c ]
-    table_names.sort()
-
-    if table_name not in table_names:
+    table = schema_catalog.get().get(table_name)
+    if table is None or "id" not in table.columns:
         return "invalid table name parameter in query string"
 
     # Build response.
+    conn = connection_pool.get()
     c = conn.cursor()
-    c.execute("SELECT * FROM %s WHERE id=%d" % (table_name, row_id))
+    c.execute("SELECT * FROM %s WHERE id=?" % quote_identifier(table_name), (row_id,))
     column_names = [ column_info[0] for column_info in c.description ]
 
     s = ""
@@ -307,7 +1713,7 @@ def page_view_row(handler, path, kwargs):
             column_name = column_names[idx]
             s += "<tr>"
             s += "<td cellpadding=5 valign=top>%s</td>" % column_name
-            s += "<td cellpadding=5 valign=top>%s</td>" % value
+            s += "<td cellpadding=5 valign=top>%s</td>" % decode_fulltext(value)
             s += "</tr>"
     s += "</table>"
     s += "</body></html>"
@@ -315,96 +1721,175 @@ def page_view_row(handler, path, kwargs):
 
 RequestHandler.page_handlers["/row"] = page_view_row
 
+def page_count(table, page_size):
+    return max(1, (table.row_count + page_size - 1) // page_size)
+
+def sortable_columns(table):
+    """The columns of the table which lead an index, and so are cheap to sort by."""
+    return set(column_names[0] for (index_name, column_names) in table.indexes if column_names)
+
+def select_table_page(table, column_names, kwargs):
+    """
+        Start reading the page of rows a /table or /api/table request asks
+        for, with the page, page_size and sort_column parameters.  Returns
+        (cursor, page, page size, sort column name), or None if the page
+        parameters are invalid.  Pages past the end are read as the last
+        page.  One row more than the page holds is read, which tells whether
+        there is a next page.
+    """
+    try:
+        page = max(1, int(kwargs.get("page", [ 1 ])[0]))
+        page_size = min(MAX_PAGE_SIZE, max(1, int(kwargs.get("page_size", [ DEFAULT_PAGE_SIZE ])[0])))
+    except ValueError:
+        return None
+    # Also keeps the offset within the range sqlite takes.
+    page = min(page, page_count(table, page_size))
+
+    # Only indexed columns can be sorted by, as any other would need every row sorted
+    # for every page.  run-parse-html.py indexes the usual ones.
+    sort_column_name = kwargs.get("sort_column", [ None ])[0]
+    if sort_column_name not in sortable_columns(table):
+        sort_column_name = table_sort_column.get(table.name, None)
+    if sort_column_name is None and "name" in table.columns:
+        sort_column_name = "name"
+    order_part = "rowid"
+    if sort_column_name is not None:
+        order_part = "%s, rowid" % quote_identifier(sort_column_name)
+
+    # Names in the SQL only ever come from the schema, and are quoted.
+    conn = connection_pool.get()
+    c = conn.cursor()
+    c.execute("SELECT %s FROM %s ORDER BY %s LIMIT ? OFFSET ?" % (", ".join(quote_identifier(column_name) for column_name in column_names),
+        quote_identifier(table.name), order_part), (page_size + 1, (page - 1) * page_size))
+    return c, page, page_size, sort_column_name
+
 def page_view_table(handler, path, kwargs):
-    # /table?name=<table_name>
+    # /table?name=<table_name>&sort_column=<column_name>&page=<page>&page_size=<page_size>
     table_name = kwargs["name"][0]
 
-    sort_column_name = None
-    if "sort_column" in kwargs:
-        sort_column_name = kwargs["sort_column"][0]
-
-    # Build response.
-    conn = sqlite3.connect(DATABASE_FILENAME)
-    s = ""
-    s += "<html><body>"
-    s += "Back to <a href='/'>table list</a>.<br/><br/>"
+    table = schema_catalog.get().get(table_name)
+    if table is None:
+        return "invalid table name parameter in query string"
 
-    c = conn.cursor()
     show_columns = table_display_columns.get(table_name, None)
     if show_columns is None:
-        column_part = "*"
+        column_names = list(table.columns)
     else:
-        column_part = ",".join(show_columns)
-    c.execute("SELECT %s FROM %s" % (column_part, table_name))
-    column_names = [ column_info[0] for column_info in c.description ]
-
-    for idx, column_name in enumerate(column_names):
-        if idx > 0:
-            s += ", "
-        if show_columns is None or column_name not in show_columns:
-            s += column_name
-        else:
-            s += "["+ column_name +"]"
-
-    s += "<table border='1'>"
-    s += "<tr>"
-    for column_name in column_names:
-        if show_columns is None or column_name in show_columns:
-            s += "<td>%s</td>" % table_link(table_name, column_name, column_name)
-    s += "</tr><br/><br/>"
+        column_names = [ column_name for column_name in show_columns if column_name in table.columns ]
+
+    result = select_table_page(table, column_names, kwargs)
+    if result is None:
+        return "invalid page parameter in query string"
+    c, page, page_size, sort_column_name = result
+
+    # Build response, a row at a time as they are read.
+    def generate():
+        yield "<html><body>"
+        yield "Back to <a href='/'>table list</a>.<br/><br/>"
+
+        for idx, column_name in enumerate(column_names):
+            if idx > 0:
+                yield ", "
+            if show_columns is None or column_name not in show_columns:
+                yield column_name
+            else:
+                yield "["+ column_name +"]"
 
-    lines = []
-    for row in c:
-        line = []
-        for idx, value in enumerate(row):
-            column_name = column_names[idx]
+        yield "<table border='1'>"
+        yield "<tr>"
+        sort_column_names = sortable_columns(table)
+        for column_name in column_names:
             if show_columns is None or column_name in show_columns:
-                if type(value) in types.StringTypes:
-                    line.append(value.encode('ascii','xmlcharrefreplace'))
+                if column_name in sort_column_names:
+                    yield "<td>%s</td>" % table_link(table_name, column_name, column_name, page_size=page_size)
                 else:
-                    line.append(value)
-        lines.append(line)
+                    yield "<td>%s</td>" % column_name
+        yield "</tr><br/><br/>"
+
+        count = 0
+        for row in c:
+            count += 1
+            if count > page_size:
+                break
+            yield "<tr>"
+            for idx, value in enumerate(row):
+                column_name = column_names[idx]
+                if show_columns is None or column_name in show_columns:
+                    value = decode_fulltext(value)
+                    if column_name == "id":
+                        value = table_row_link(table_name, value)
+                    yield "<td valign=top>%s</td>" % value
+            yield "</tr>"
+        yield "</table>"
+
+        yield "Page %d of %d: " % (page, page_count(table, page_size))
+        if page > 1:
+            yield table_link(table_name, sort_column_name, "previous", page - 1, page_size) +" "
+        if count > page_size:
+            yield table_link(table_name, sort_column_name, "next", page + 1, page_size)
+        yield "</body></html>"
+    return generate()
 
-    if sort_column_name is None or sort_column_name not in column_names:
-        sort_column_name = table_sort_column.get(table_name, None)
-    if sort_column_name is None and "name" in column_names:
-        sort_column_name = "name"
-    if sort_column_name is not None:
-        idx = column_names.index(sort_column_name)
-        lines.sort(lambda a, b: cmp(a[idx], b[idx]))
+RequestHandler.page_handlers["/table"] = page_view_table
 
-    for line in lines:
-        s += "<tr>"
-        for idx, value in enumerate(line):
-            column_name = column_names[idx]
-            if column_name == "id":
-                value = table_row_link(table_name, value)
-            s += "<td valign=top>%s</td>" % value
-        s += "</tr>"
+def search_form(query=""):
+    return "<form action='/search'><input name='q' value=\"%s\"/> <input type='submit' value='Search'/></form>" % cgi.escape(query, True)
 
-    s += "</table>"
-    s += "</body></html>"
-    return s
+def search_match_expression(query):
+    # Each word is a quoted FTS5 string, so user input is never query syntax.
+    return " ".join("\"%s\"" % word.replace("\"", "\"\"") for word in query.split())
 
-RequestHandler.page_handlers["/table"] = page_view_table
+def page_search(handler, path, kwargs):
+    # /search?q=<words>
+    query = kwargs.get("q", [ "" ])[0].decode("utf-8", "replace")
 
-def page_list_tables(hander, path, kwargs):
-    conn = sqlite3.connect(DATABASE_FILENAME)
-    s = ""
-    s += "<html><body>"
+    header = "<html><body>"
+    header += "Back to <a href='/'>table list</a>.<br/><br/>"
+    header += search_form(query)
+
+    match_expression = search_match_expression(query)
+    if not match_expression:
+        return header + "</body></html>"
+
+    conn = connection_pool.get()
     c = conn.cursor()
-    c.execute("SELECT * FROM sqlite_master WHERE type='table'")
+    try:
+        # Matches in the name count for more than those in the text.
+        c.execute("SELECT table_name, row_id, name, snippet(%s, 1, '\x02', '\x03', '...', 24) FROM %s "
+            "WHERE %s MATCH ? ORDER BY bm25(%s, 10.0, 1.0) LIMIT %d" % ((SEARCH_INDEX_TABLE,) * 4 + (SEARCH_RESULT_LIMIT,)),
+            (match_expression,))
+    except sqlite3.OperationalError:
+        return header + "the search index is missing, rebuild the database to create it</body></html>"
+
+    # Build response, a result at a time as they are read.
+    def generate():
+        yield header
+        yield "<table border='1'>"
+        for (table_name, row_id, name, snippet) in c:
+            snippet = cgi.escape(snippet).replace("\x02", "<b>").replace("\x03", "</b>")
+            yield "<tr>"
+            yield "<td valign=top>%s</td>" % table_link(table_name)
+            yield "<td valign=top>%s</td>" % table_row_link(table_name, row_id, cgi.escape(name or str(row_id)))
+            yield "<td valign=top>%s</td>" % snippet
+            yield "</tr>"
+        yield "</table>"
+        yield "</body></html>"
+    return generate()
+
+RequestHandler.page_handlers["/search"] = page_search
 
-    column_names = [ column_info[0] for column_info in c.description ]
-    idx = column_names.index("tbl_name")
-    table_names = [ row[idx] for row in c ]
-    table_names.sort()
+def page_list_tables(hander, path, kwargs):
+    schema = schema_catalog.get()
 
+    s = ""
+    s += "<html><body>"
+    s += search_form()
     s += "dnd35.sqlite tables:<br/><br/>"
     s += "<table border='1'>"
-    for table_name in table_names:
+    for table_name in sorted(name for name in schema if not schema[name].internal):
         s += "<tr>"
         s += "<td>%s</td>" % table_link(table_name)
+        s += "<td align=right>%d</td>" % schema[table_name].row_count
         s += "</tr>"
     s += "</table>"
     s += "</body></html>"
@@ -413,15 +1898,181 @@ def page_list_tables(hander, path, kwargs):
 RequestHandler.page_handlers["/"] = page_list_tables
 RequestHandler.page_handlers["/home"] = page_list_tables
 
-def run():
-    address = ('127.0.0.1', 9000)
-    print "Starting web server on %s port %d" % address
-    server = HTTPServer(address, RequestHandler)
+#####
+# JSON API.
+
+def json_value(value):
+    value = decode_fulltext(value)
+    # JSON has no binary type.
+    if isinstance(value, buffer):
+        return base64.b64encode(value)
+    return value
+
+def json_error(message):
+    return json.dumps({ "error": message })
+
+def json_columns(table, kwargs):
+    """The columns asked for in the columns parameter, or all of them.  None if any are unknown."""
+    if "columns" not in kwargs:
+        return list(table.columns)
+    column_names = [ column_name.strip() for column_name in kwargs["columns"][0].split(",") if column_name.strip() ]
+    for column_name in column_names:
+        if column_name not in table.columns:
+            return None
+    return column_names or None
+
+def json_rows(c):
+    # The rows are written as they are read, as arrays in the order of the columns.
+    first = True
+    for row in c:
+        yield ("[" if first else ",") + json.dumps([ json_value(value) for value in row ])
+        first = False
+    yield "[]" if first else "]"
+
+def page_api_schema(handler, path, kwargs):
+    # /api/schema
+    schema = schema_catalog.get()
+    tables = {}
+    for table in schema.itervalues():
+        if table.internal:
+            continue
+        tables[table.name] = {
+            "columns": [ { "name": name, "type": column_type } for (name, column_type) in zip(table.columns, table.column_types) ],
+            "row_count": table.row_count,
+            "indexes": [ { "name": index_name, "columns": list(column_names) } for (index_name, column_names) in table.indexes ],
+        }
+    return json.dumps({ "tables": tables }, sort_keys=True)
+
+RequestHandler.page_handlers["/api/schema"] = page_api_schema
+RequestHandler.page_content_types["/api/schema"] = "application/json"
+
+def page_api_table(handler, path, kwargs):
+    # /api/table?name=<table_name>&columns=<column_name>,..&sort_column=<column_name>&page=<page>&page_size=<page_size>
+    table = schema_catalog.get().get(kwargs.get("name", [ "" ])[0])
+    if table is None:
+        return json_error("invalid table name parameter in query string")
+    column_names = json_columns(table, kwargs)
+    if column_names is None:
+        return json_error("invalid columns parameter in query string")
+
+    result = select_table_page(table, column_names, kwargs)
+    if result is None:
+        return json_error("invalid page parameter in query string")
+    c, page, page_size, sort_column_name = result
+
+    # The rows are streamed into the object, after the rest of its members.
+    def generate():
+        yield json.dumps({ "table": table.name, "columns": column_names, "page": page, "page_size": page_size,
+            "row_count": table.row_count })[:-1]
+        yield ",\"rows\":"
+        for fragment in json_rows(itertools.islice(c, page_size)):
+            yield fragment
+        yield "}"
+    return generate()
+
+RequestHandler.page_handlers["/api/table"] = page_api_table
+RequestHandler.page_content_types["/api/table"] = "application/json"
+
+def page_api_rows(handler, path, kwargs):
+    # /api/rows?table=<table_name>&ids=<id>,<id>..&columns=<column_name>,..
+    table = schema_catalog.get().get(kwargs.get("table", [ "" ])[0])
+    if table is None or "id" not in table.columns:
+        return json_error("invalid table name parameter in query string")
+    column_names = json_columns(table, kwargs)
+    if column_names is None:
+        return json_error("invalid columns parameter in query string")
+
+    try:
+        ids = [ int(row_id) for row_id in kwargs.get("ids", [ "" ])[0].split(",") if row_id.strip() ]
+    except ValueError:
+        return json_error("invalid ids parameter in query string")
+    if len(ids) > MAX_BATCH_IDS:
+        return json_error("at most %d ids can be fetched at once" % MAX_BATCH_IDS)
+
+    # The id is needed to put the rows in the order asked for, even if it is not wanted.
+    select_column_names = [ "id" ] + column_names
+    rows_by_id = {}
+    if ids:
+        conn = connection_pool.get()
+        c = conn.cursor()
+        c.execute("SELECT %s FROM %s WHERE id IN (%s)" % (", ".join(quote_identifier(column_name) for column_name in select_column_names),
+            quote_identifier(table.name), ",".join("?" for row_id in ids)), ids)
+        for row in c:
+            rows_by_id[row[0]] = [ json_value(value) for value in row[1:] ]
+
+    return json.dumps({
+        "table": table.name,
+        "columns": column_names,
+        "rows": [ rows_by_id[row_id] for row_id in ids if row_id in rows_by_id ],
+        "missing": [ row_id for row_id in ids if row_id not in rows_by_id ],
+    })
+
+RequestHandler.page_handlers["/api/rows"] = page_api_rows
+RequestHandler.page_content_types["/api/rows"] = "application/json"
+
+#####
+# Metrics.
+
+def page_metrics(handler, path, kwargs):
+    return metrics.render()
+
+RequestHandler.page_handlers["/metrics"] = page_metrics
+RequestHandler.page_content_types["/metrics"] = "text/plain; version=0.0.4"
+RequestHandler.uncached_pages.add("/metrics")
+
+def run(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+        max_body_size=MAX_BODY_SIZE):
+    address = (host, port)
+    print "Starting web server on %s port %d with %d workers" % (address + (workers,))
+    # The schema is read before serving, and again only after the database is replaced.
+    schema_catalog.get()
+    server = ThreadPoolHTTPServer(address, RequestHandler, workers, queue_size, max_body_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_async(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=DEFAULT_WORKERS, request_timeout=DEFAULT_REQUEST_TIMEOUT,
+        max_body_size=MAX_BODY_SIZE):
+    address = (host, port)
+    print "Starting asynchronous web server on %s port %d with %d workers" % (address + (workers,))
+    # The schema is read before serving, and again only after the database is replaced.
+    schema_catalog.get()
+    server = AsyncHTTPServer(address, workers, request_timeout, max_body_size)
+    signal.signal(signal.SIGTERM, server.stop)
     server.serve_forever()
 
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Browse the DND35 SQLite database in a web browser.")
+    parser.add_argument("--host", default=DEFAULT_HOST,
+        help="address to listen on (default: %s)" % DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+        help="port to listen on (default: %d)" % DEFAULT_PORT)
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS,
+        help="number of worker threads serving requests (default: %d)" % DEFAULT_WORKERS)
+    parser.add_argument("-q", "--queue", type=int, default=DEFAULT_QUEUE_SIZE,
+        help="connections that can wait for a free worker (default: %d)" % DEFAULT_QUEUE_SIZE)
+    parser.add_argument("-a", "--async", dest="use_async", action="store_true",
+        help="serve connections from an event loop, rendering pages in the worker threads")
+    parser.add_argument("-t", "--timeout", type=float, default=DEFAULT_REQUEST_TIMEOUT,
+        help="seconds a page can take to render with --async (default: %d)" % DEFAULT_REQUEST_TIMEOUT)
+    parser.add_argument("-l", "--access-log", metavar="FILE",
+        help="append a line of JSON for each request to FILE, or stdout for -")
+    parser.add_argument("-b", "--max-body-size", type=int, default=MAX_BODY_SIZE,
+        help="bytes a POST request body can have (default: %d)" % MAX_BODY_SIZE)
+    options = parser.parse_args()
+
+    if options.access_log is not None:
+        access_log.open(options.access_log)
+
+    if options.use_async:
+        run_async(options.host, options.port, max(1, options.workers), options.timeout, options.max_body_size)
+    else:
+        run(options.host, options.port, max(1, options.workers), max(1, options.queue), options.max_body_size)
     print "Main thread exited"
 
 
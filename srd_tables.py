@@ -0,0 +1,88 @@
+"""
+LICENSE
+
+    pysrd - Python scripts for working with the DND35 OGL SRD.
+    Copyright (C) 2012, 2013 Richard Tew
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+OVERVIEW
+
+    What the scripts share about the tables of the DND35 SQLite database.
+    It is imported by run-parse-html.py, run-webserver.py and run-export.py,
+    and must be kept in the same directory as them.
+
+    run-parse-html.py can store larger html text as zlib compressed UTF-8
+    BLOBs, which are read back with decode_fulltext.
+
+    Hard coded variables:
+
+        internal_table_names:       tables run-parse-html.py keeps for its own
+                                    use, which hold no data.
+        table_display_columns:      columns run-webserver.py shows, by table
+                                    name.  run-parse-html.py indexes them.
+        table_sort_column:          default sorting column for specific
+                                    tables, also indexed.
+"""
+
+import zlib
+
+
+internal_table_names = [ "build_manifest" ]
+
+table_display_columns = {
+    "abilities":            [ "id", "name", "shortname" ],
+    "class":                [ "id", "name", "type" ],
+    "class_table":          [ "id", "name", "level" ],
+    "conditions":           [ "id", "name" ],
+    "domain":               [ "id", "name" ],
+    "equipment":            [ "id", "name", "family", "category", "subcategory" ],
+    "feat":                 [ "id", "name", "type" ],
+    "item":                 [ "id", "name", "category", "subcategory" ],
+    "monster":              [ "id", "family", "name", "altname", "size", "type", "descriptor", "environment" ],
+    "power":                [ "id", "name", "discipline", "subdiscipline", "descriptor" ],
+    "skill":                [ "id", "name", "subtype" ],
+    "special_abilities":    [ "id", "name" ],
+    "spell":                [ "id", "name", "school", "subschool", "descriptor" ],
+}
+
+table_sort_column = {
+    "class": "name",
+}
+
+
+def data_table_names(tables):
+    """
+        The names of the tables holding data, given (name, sql) rows from
+        sqlite_master.  SQLite's own tables, like sqlite_stat1, the virtual
+        tables, like the search index, and the tables those keep their data
+        in are left out, along with the tables run-parse-html.py keeps.
+    """
+    virtual_table_names = [ name for (name, sql) in tables if (sql or "").upper().startswith("CREATE VIRTUAL TABLE") ]
+    return sorted(name for (name, sql) in tables if not name.startswith("sqlite_")
+        and name not in internal_table_names and name not in virtual_table_names
+        and not [ vname for vname in virtual_table_names if name.startswith(vname +"_") ])
+
+
+def decode_fulltext(value):
+    """
+        Stored html text, decompressed if it is a zlib compressed UTF-8 BLOB.
+        Any other value is returned as it is, including other BLOBs.
+    """
+    if isinstance(value, buffer):
+        try:
+            return zlib.decompress(value).decode("utf-8")
+        except zlib.error:
+            pass
+    return value